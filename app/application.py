@@ -3,29 +3,81 @@
 
 
 import os
+import sys
+import json
 import queue
+import signal
 import asyncio
-from time import sleep
+from time import sleep, time as wallclock
 from app.config import Config
 from app.mqtt import MQTTClient as mqttClk
 from app.influxdb import InfluxClient as influxClk
 from app.prometheus import PrometheusClient as prometheusClk
+from app.profiler import ProfilerClient as profilerClk
+from app.poller import HTTPPoller as pollerClk
+from app.quality import PowerQualityAnalyzer as qualityClk
 from app.sensors.pzem004t import *
 
 MQTT_TOPIC = 'tele/pzem004tv3_87A0B8/SENSOR'
+QUEUE_SIZE = 10000
+BATCH_SIZE = 0
+SHUTDOWN_TIMEOUT = 8
+## share of shutdown timeout for processing queue, rest is left for pending writes
+SHUTDOWN_DRAIN_SHARE = 0.75
+WRITE_CHUNK_SIZE = 1000
+SPOOL_FILE = 'persistent/queue.spool'
 
 class Application(object):
 
     def __init__(self, pwd, logger) -> None:
+
+        ## get class name
+        self.module_name = type(self).__name__
+
         self.pwd = pwd
         self.logger = logger
         self.config = Config(self.logger, self.pwd)
+        self.QUEUE_SIZE, self.BATCH_SIZE, self.SHUTDOWN_TIMEOUT, self.SPOOL_FILE = self._config(self.config)
+        self.MQTT_TOPIC = self._topic(self.config)
         self.mqtt = mqttClk(logger, self.config)
         self.influx = influxClk(logger, self.config)
         self.prometheus = prometheusClk(logger, self.config)
-        self.queue = queue.Queue()
+        self.profiler = profilerClk(logger, self.config)
+        self.poller = pollerClk(logger, self.config)
+        self.quality = qualityClk(logger, self.config)
+        self.queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+        self.batch = PZEM004TBatch(self.config) if self.BATCH_SIZE else None
+        self.tasks = {}
+        self.stopping = None
+        self.draining = None
+        self.deadline = None
         #self.sensors = []
 
+    ## Read module configuration
+    def _config(self, config: Config):
+        try:
+            ## load configuration, module is optional
+            config = config.modules()
+            module = config.get(self.module_name) or {}
+
+            ## parse configuration
+            size = int(os.getenv('QUEUE_SIZE', module.get('queue_size', QUEUE_SIZE)))
+            batch = int(os.getenv('BATCH_SIZE', module.get('batch_size', BATCH_SIZE)))
+            timeout = float(os.getenv('SHUTDOWN_TIMEOUT', module.get('shutdown_timeout', SHUTDOWN_TIMEOUT)))
+            spool = os.path.join(self.pwd, os.getenv('SPOOL_FILE', module.get('spool_file', SPOOL_FILE)))
+            return size, batch, timeout, spool
+        except Exception as e:
+            self.logger.critical('[APP] Cannot read configuration for module. Details {}'.format(e))
+            sys.exit(1)
+
+    ## Read sensor topic, may contain MQTT wildcards for a fleet of devices
+    def _topic(self, config: Config) -> str:
+        try:
+            sensor = config.sensors()[PZEM004TSensor.__name__]
+            return os.getenv('MQTT_TOPIC', sensor['mqtt']['topic'])
+        except (KeyError, TypeError):
+            return os.getenv('MQTT_TOPIC', MQTT_TOPIC)
+
     #def loadModules(self):
     #    print('Not implemented')    
 
@@ -33,16 +85,44 @@ class Application(object):
     def onMessageCallback(self, topic, payload):
         self.logger.debug('[APP] Got MQTT callback with topic {} and message {}'.format(topic, payload))
 
-        ## add payload to queue
-        self.queue.put(payload)
+        ## device clock has no zone, message is stamped on arrival
+        self.enqueue((topic, payload, wallclock()))
         self.logger.debug('[APP] Adding to queue payload: {}.'.format(payload))
 
+    ## add message to queue, drop oldest message when queue is full
+    def enqueue(self, message: tuple) -> None:
+        while True:
+            try:
+                self.queue.put(message, block=False)
+                break
+            except queue.Full:
+                try:
+                    dropped = self.queue.get(block=False)
+                    self.logger.warning('[APP] Queue is full, dropping oldest payload: {}.'.format(dropped))
+                except queue.Empty:
+                    pass
+
+    ## Retry failed writes with records rendered before, pause processing while too many writes are pending
+    def canProcess(self) -> bool:
+        if not self.influx.isEnabled():
+            return True
+
+        ## messages are not decoded, analyzed and published again
+        failed = self.influx.takeFailed()
+        if failed:
+            self.influx.write_batch(failed)
+
+        if not self.influx.canWrite():
+            self.logger.debug('[APP] Too many pending writes to InfluxDB, queue processing paused.')
+            return False
+        return True
+
 
     ## async mqtt client
     async def asyncMqtt(self, loop):
         task = asyncio.current_task(loop)
         client = self.mqtt.initialize(self.onMessageCallback)
-        self.mqtt.subscribe(client, MQTT_TOPIC)
+        self.mqtt.subscribe(client, self.MQTT_TOPIC)
         await asyncio.sleep(3)
         
         ## create loop for MQTT client
@@ -51,8 +131,8 @@ class Application(object):
                 self.logger.debug('[APP] Connection to MQTT is alive.')
             else:
                 self.logger.critical('[APP] Connection to MQTT is dead. Reconnection in progress.')
-                client = self.mqtt.reconnect()
-                self.mqtt.subscribe(client, MQTT_TOPIC)
+                client = self.mqtt.reconnect(self.onMessageCallback)
+                self.mqtt.subscribe(client, self.MQTT_TOPIC)
 
             await asyncio.sleep(10)
 
@@ -60,13 +140,14 @@ class Application(object):
     async def asyncInfluxDb(self, loop):
         task = asyncio.current_task(loop)
         self.influx.connect()
-        ## create loop for influx client
+        ## create loop for influx client, health requests are blocking and run off the event loop
         while True:
-            if self.influx.isConnected():
-                self.logger.debug('[APP] Connection to InfluxDB is alive.')
-            else:
-                self.logger.critical('[APP] Connection to InfluxDB is dead. Reconecting')
-                self.influx.connect()
+            for pool in self.influx.poolKeys():
+                if await loop.run_in_executor(None, self.influx.isPoolConnected, pool):
+                    self.logger.debug('[APP] Connection to InfluxDB {} is alive.'.format(pool[0]))
+                else:
+                    self.logger.critical('[APP] Connection to InfluxDB {} is dead. Reconecting'.format(pool[0]))
+                    self.influx.reconnect(pool)
 
             await asyncio.sleep(10)
 
@@ -77,40 +158,245 @@ class Application(object):
 
         #self.logger.debug('[APP] Process: {}, status: alive.'.format(task.get_name()))
 
+        ## create loop for removing series and analyzer state of silent devices
+        while True:
+            await asyncio.sleep(60)
+            self.prometheus.evict()
+            self.quality.evict()
+
+    ## async http poller client
+    async def asyncPoller(self, loop):
+        task = asyncio.current_task(loop)
+        self.logger.debug('[APP] Process: {}, status: alive.'.format(task.get_name()))
+        await self.poller.run(self.onMessageCallback)
+
+    ## async profiler endpoint
+    async def asyncProfilerWorker(self, loop):
+        task = asyncio.current_task(loop)
+        self.profiler.start(loop)
+
     ## async queue client
     async def asyncQueueWorker(self, loop):
         task = asyncio.current_task(loop)
         self.logger.debug('[APP] Process: {}, status: alive.'.format(task.get_name()))
 
+        while not self.draining.is_set():
+            await self.processQueue(task)
+
+            try:
+                await asyncio.wait_for(self.draining.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+
+        ## intake is stopped, process what is left until deadline
+        await self.processQueue(task)
+        self.logger.debug('[APP] Process: {}, status: stopped.'.format(task.get_name()))
+
+    ## Check if shutdown deadline is reached
+    def isOverdue(self) -> bool:
+        return self.deadline is not None and asyncio.get_running_loop().time() > self.deadline
+
+    ## process messages received since last iteration
+    async def processQueue(self, task):
+        if not self.canProcess():
+            return
+
+        if self.batch is not None:
+            await self.processBatches(task)
+            return
+
+        batch = []
+        for _ in range(self.queue.qsize()):
+            if self.isOverdue():
+                break
+
+            try:
+                message = self.queue.get(block=False)
+                topic, payload, received = message
+                self.logger.debug('[APP] Got message from queue: {}'.format(payload))
+
+                pzem004 = PZEM004TSensor(payload)
+                results = pzem004.get(self.config, topic, received)
+                batch.append((topic, results, message))
+
+                if self.quality.isEnabled():
+                    events = self.quality.analyze(topic, pzem004.sensor, results[0]['time'])
+                    if events:
+                        batch.append((topic, events, None))
+                        if self.prometheus.isEnabled():
+                            self.prometheus.publishEvents(events)
+
+                if self.prometheus.isEnabled():
+                    self.prometheus.publish(results)
+
+                if len(batch) >= WRITE_CHUNK_SIZE and self.influx.isEnabled():
+                    self.influx.write_batch(batch)
+                    batch = []
+                    if not self.canProcess():
+                        break
+
+            except Exception as error:
+                self.logger.error('[APP] Process: {}. Will clean up queue. Error: {}'.format(task.get_name(), error))
+                self.queue.empty()
+                continue
+
+            ## let other tasks run while draining a long queue
+            await asyncio.sleep(0)
+
+        if batch and self.influx.isEnabled():
+            self.influx.write_batch(batch)
+
+    ## process queue in column batches of up to BATCH_SIZE messages
+    async def processBatches(self, task):
+        while not self.queue.empty() and not self.isOverdue() and self.canProcess():
+            messages = []
+            try:
+                while len(messages) < self.BATCH_SIZE:
+                    messages.append(self.queue.get(block=False))
+            except queue.Empty:
+                pass
+
+            try:
+                columns = self.batch.decode(messages)
+                self.logger.debug('[APP] Decoded {} of {} messages from queue.'.format(len(columns['topic']), len(messages)))
+
+                events = []
+                if self.quality.isEnabled():
+                    events = self.quality.analyzeColumns(columns)
+
+                if self.influx.isEnabled():
+                    self.influx.write_batch(self.batch.toLineProtocol(columns) + [
+                        (topic, deviceEvents, None) for topic, deviceEvents in events
+                    ])
+
+                if self.prometheus.isEnabled():
+                    self.prometheus.publish(self.batch.latest(columns))
+                    for topic, deviceEvents in events:
+                        self.prometheus.publishEvents(deviceEvents)
+
+            except Exception as error:
+                self.logger.error('[APP] Process: {}. Dropping batch of {} messages. Error: {}'.format(task.get_name(), len(messages), error))
+
+            ## let other tasks run while draining a long queue
+            await asyncio.sleep(0)
+
+    ## Save given messages and messages left in queue, they are processed on next start
+    def spool(self, messages: list) -> int:
+        messages = list(messages)
         while True:
-            if not self.queue.empty():
+            try:
+                messages.append(self.queue.get(block=False))
+            except queue.Empty:
+                break
 
-                try:
-                    message = self.queue.get(block=False)
-                    self.logger.debug('[APP] Got message from queue: {}'.format(message))
+        if messages:
+            with open(self.SPOOL_FILE, 'a') as file:
+                for topic, payload, received in messages:
+                    file.write(json.dumps({'topic': topic, 'payload': payload, 'received': received}) + '\n')
+
+        return len(messages)
 
-                    pzem004 = PZEM004TSensor(message)
-                    results = pzem004.get(self.config)
+    ## Put messages saved on previous shutdown back to queue
+    def restore(self) -> int:
+        if not os.path.exists(self.SPOOL_FILE):
+            return 0
 
-                    if self.influx.isEnabled():
-                        self.influx.write_over_api(results)
+        count = 0
+        skipped = 0
+        try:
+            ## binary mode, broken encoding of one line must not stop reading
+            with open(self.SPOOL_FILE, 'rb') as file:
+                for line in file:
+                    try:
+                        message = json.loads(line)
+                        self.enqueue((message['topic'], message['payload'], message.get('received') or wallclock()))
+                        count += 1
+                    except (ValueError, KeyError, TypeError):
+                        skipped += 1
+        except OSError as error:
+            self.logger.error('[APP] Cannot restore messages from {}. Error: {}'.format(self.SPOOL_FILE, error))
+        finally:
+            ## restored messages are in queue now, file must not be replayed on next start
+            try:
+                os.remove(self.SPOOL_FILE)
+            except OSError as error:
+                self.logger.error('[APP] Cannot remove {}. Error: {}'.format(self.SPOOL_FILE, error))
 
-                    if self.prometheus.isEnabled():
-                        self.prometheus.publish(results)
+        if skipped:
+            self.logger.error('[APP] Skipped {} malformed lines of {}.'.format(skipped, self.SPOOL_FILE))
+        self.logger.info('[APP] Restored {} messages from {}.'.format(count, self.SPOOL_FILE))
+        return count
 
-                except Exception as error:
-                    self.logger.error('[APP] Process: {}. Will clean up queue. Error: {}'.format(task.get_name(), error))
-                    self.queue.empty()
-                    continue
+    ## Request shutdown, called from signal handler
+    def stop(self, signum=None) -> None:
+        if not self.stopping.is_set():
+            self.logger.info('[APP] Got signal {}, shutting down.'.format(signum))
+            self.stopping.set()
+
+    ## Stop intake, drain queue, flush writes and spool what did not make it before deadline
+    async def shutdown(self, loop):
+        started = loop.time()
+        deadline = started + self.SHUTDOWN_TIMEOUT
+        self.deadline = started + self.SHUTDOWN_TIMEOUT * SHUTDOWN_DRAIN_SHARE
+
+        ## stop accepting new messages, broker keeps session and undelivered messages
+        for name in ('mqtt', 'poller'):
+            if name in self.tasks:
+                self.tasks[name].cancel()
+        self.mqtt.disconnect()
+
+        ## queue worker finishes by itself once draining is set
+        self.draining.set()
+        worker = self.tasks.pop('queue')
+        try:
+            await asyncio.wait_for(worker, max(0, self.deadline - loop.time()) + 1)
+        except asyncio.TimeoutError:
+            self.logger.error('[APP] Queue worker did not finish before deadline.')
+
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+        ## wait for pending writes without blocking the loop
+        while self.influx.pending() and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+
+        ## pending and failed writes are saved together with queue
+        pending = self.influx.pending()
+        abandoned = self.influx.abandon()
+        if pending:
+            self.logger.error('[APP] {} writes to InfluxDB are still pending, their messages are saved.'.format(pending))
+
+        spooled = self.spool(abandoned)
+        if spooled:
+            self.logger.warning('[APP] Saved {} unprocessed messages to {}.'.format(spooled, self.SPOOL_FILE))
+
+        self.influx.close()
+        self.profiler.stop()
+
+        self.logger.info('[APP] Shutdown finished in {:.2f}s.'.format(loop.time() - started))
 
-            await asyncio.sleep(1)
-            
     ## entrypoint
     def main(self):
         ## create async thread pool
         loop = asyncio.get_event_loop()
-        loop.create_task(self.asyncInfluxDb(loop), name='influxdb')
-        loop.create_task(self.asyncMqtt(loop), name='mqtt')
-        loop.create_task(self.asyncPrometheusWorker(loop), name='prometheus')
-        loop.create_task(self.asyncQueueWorker(loop), name='queue')
-        loop.run_forever()
\ No newline at end of file
+        self.stopping = asyncio.Event()
+        self.draining = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stop, signum)
+
+        self.restore()
+
+        self.tasks['influxdb'] = loop.create_task(self.asyncInfluxDb(loop), name='influxdb')
+        self.tasks['mqtt'] = loop.create_task(self.asyncMqtt(loop), name='mqtt')
+        self.tasks['prometheus'] = loop.create_task(self.asyncPrometheusWorker(loop), name='prometheus')
+        self.tasks['queue'] = loop.create_task(self.asyncQueueWorker(loop), name='queue')
+
+        if self.poller.isEnabled():
+            self.tasks['poller'] = loop.create_task(self.asyncPoller(loop), name='poller')
+
+        if self.profiler.isEnabled():
+            self.tasks['profiler'] = loop.create_task(self.asyncProfilerWorker(loop), name='profiler')
+
+        loop.run_until_complete(self.stopping.wait())
+        loop.run_until_complete(self.shutdown(loop))
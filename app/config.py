@@ -28,7 +28,8 @@ class Config(object):
         try:
             stream = "{}{}{}{}{}".format(self.rootPath, os.sep, self.configDir, os.sep, self.configFile)
             yaml = YAML(typ='safe')
-            content = yaml.load(open(stream))
+            with open(stream) as file:
+                content = yaml.load(file)
             return content[entity]
         except (FileNotFoundError, AttributeError, YAMLError, KeyError, IndexError, ValueError, TypeError) as e:
             self.logger.critical('[{}] Cannot load configuration file. Details {}.'.format(self.module_name, e))  
@@ -2,11 +2,48 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 import sys
+import fnmatch
 import logging
+import threading
+from collections import deque
 from app.config import Config
-from influxdb_client import InfluxDBClient, Point
+from app.sensors.pzem004t import topicDevice
+from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS, ASYNCHRONOUS
+from influxdb_client.service.health_service import HealthService
+
+INFLUXDB_MAX_INFLIGHT = 1000
+INFLUXDB_ROUTES_CACHE_SIZE = 65536
+INFLUXDB_HEALTH_TIMEOUT = 2
+
+## Convert MQTT subscription pattern (+ and # wildcards) to regular expression
+def topicPattern(pattern: str) -> str:
+    levels = []
+    for level in pattern.split('/'):
+        if level == '+':
+            levels.append('[^/]*')
+        elif level == '#':
+            levels.append('.*')
+        else:
+            levels.append(re.escape(level))
+    return '/'.join(levels).replace('/.*', '(/.*)?') + r'\Z'
+
+class InfluxDestination(object):
+    """ Organization and bucket written by one routing rule """
+
+    def __init__(self, url: str, token: str, org: str, bucket: str) -> None:
+        self.url = url
+        self.token = token
+        self.org = org
+        self.bucket = bucket
+
+        ## destinations on the same server share connection pool
+        self.pool = (url, token, org)
+
+    def __repr__(self) -> str:
+        return '{}/{}/{}'.format(self.url, self.org, self.bucket)
 
 class InfluxClient(object):
 
@@ -17,7 +54,15 @@ class InfluxClient(object):
         self.client = None
         self.logger = logger
         self.write_api = None
-        self.INFLUXDB_URL, self.INFLUXDB_TOKEN, self.INFLUXDB_ORG, self.INFLUXDB_BUCKET, self.INFLUXDB_ENABLED = self._config(config)
+        self.pools = {}
+        self.lookup = {}
+        self.inflight = deque()
+        self.failed = []
+        self.INFLUXDB_URL, self.INFLUXDB_TOKEN, self.INFLUXDB_ORG, self.INFLUXDB_BUCKET, self.INFLUXDB_ENABLED, \
+            self.INFLUXDB_MAX_INFLIGHT, self.INFLUXDB_HEALTH_TIMEOUT, routes = self._config(config)
+
+        self.destination = InfluxDestination(self.INFLUXDB_URL, self.INFLUXDB_TOKEN, self.INFLUXDB_ORG, self.INFLUXDB_BUCKET)
+        self.routes = self._routes(routes)
 
     ## Read module configuration
     def _config(self, config: Config):
@@ -32,29 +77,79 @@ class InfluxClient(object):
             org = os.getenv('INFLUXDB_ORG', module['org'])
             bucket = os.getenv('INFLUXDB_BUCKET', module['bucket'])
             enabled = os.getenv('INFLUXDB_ENABLED', module['enabled'])
-            return url, token, org, bucket, enabled
+            inflight = int(os.getenv('INFLUXDB_MAX_INFLIGHT', module.get('max_inflight', INFLUXDB_MAX_INFLIGHT)))
+            health = float(os.getenv('INFLUXDB_HEALTH_TIMEOUT', module.get('health_timeout', INFLUXDB_HEALTH_TIMEOUT)))
+            routes = module.get('routes') or []
+            return url, token, org, bucket, enabled, inflight, health, routes
         except Exception as e:
             self.logger.critical('[InfluxDB] Cannot read configuration for module. Details {}'.format(e))
             sys.exit(1)
 
-    ## Connect to InfluxDB server
+    ## Compile routing rules, omitted connection settings are inherited from module
+    def _routes(self, routes: list) -> list:
+        try:
+            compiled = []
+            for route in routes:
+                match = route.get('match') or {}
+                device = re.compile(fnmatch.translate(match['device'])) if 'device' in match else None
+                topic = re.compile(topicPattern(match['topic'])) if 'topic' in match else None
+                destination = InfluxDestination(
+                    route.get('url', self.INFLUXDB_URL),
+                    route.get('token', self.INFLUXDB_TOKEN),
+                    route.get('org', self.INFLUXDB_ORG),
+                    route.get('bucket', self.INFLUXDB_BUCKET)
+                )
+                compiled.append((device, topic, destination))
+            return compiled
+        except Exception as e:
+            self.logger.critical('[InfluxDB] Cannot read routes configuration. Details {}'.format(e))
+            sys.exit(1)
+
+    ## Get destination for topic, first matching rule wins
+    def route(self, topic: str = None) -> InfluxDestination:
+        if topic is None or not self.routes:
+            return self.destination
+
+        destination = self.lookup.get(topic)
+        if destination is None:
+            destination = self.destination
+            device = topicDevice(topic)
+            for deviceRegex, topicRegex, routeDestination in self.routes:
+                if deviceRegex is not None and not deviceRegex.match(device):
+                    continue
+                if topicRegex is not None and not topicRegex.match(topic):
+                    continue
+                destination = routeDestination
+                break
+
+            if len(self.lookup) >= INFLUXDB_ROUTES_CACHE_SIZE:
+                self.lookup.clear()
+            self.lookup[topic] = destination
+
+        return destination
+
+    ## Connect to InfluxDB servers, one client per server and organization
     def connect(self) -> InfluxDBClient or None:
-        result = None
-        if self.client is None:
+        for destination in [self.destination] + [route[2] for route in self.routes]:
+            if destination.pool in self.pools:
+                continue
+
             try:
-                self.client = InfluxDBClient(
-                    url=self.INFLUXDB_URL,
-                    token=self.INFLUXDB_TOKEN,
-                    org=self.INFLUXDB_ORG
+                client = InfluxDBClient(
+                    url=destination.url,
+                    token=destination.token,
+                    org=destination.org
                 )
 
-                self.write_api = self.client.write_api(write_options=ASYNCHRONOUS)
-                self.logger.info('[InfluxDB] Connected to InfluxDB successfully')
-                return self.client
+                self.pools[destination.pool] = (client, client.write_api(write_options=ASYNCHRONOUS))
+                self.logger.info('[InfluxDB] Connected to InfluxDB {} successfully'.format(destination))
             except Exception as e:
-                self.logger.critical('[InfluxDB] Cannot connect to InfluxDB {}. Details {}.'.format(self.INFLUXDB_URL, e))
+                self.logger.critical('[InfluxDB] Cannot connect to InfluxDB {}. Details {}.'.format(destination.url, e))
 
-        return result
+        if self.destination.pool in self.pools:
+            self.client, self.write_api = self.pools[self.destination.pool]
+
+        return self.client
 
     ## Check of module enabled
     def isEnabled(self) -> bool:
@@ -65,28 +160,129 @@ class InfluxClient(object):
             self.logger.debug('[InfluxDB] Module is disabled. Enable module in config/app.yaml if needed.')
             return False
 
-    def reconnect(self):
+    ## Replace connection pool of one server, all pools when none given
+    def reconnect(self, pool: tuple = None):
+        self.close(pool)
         return self.connect()
 
-    def isConnected(self) -> bool:
+    ## Release connection pools without waiting for pending writes
+    def close(self, pool: tuple = None) -> None:
+        pools = list(self.pools) if pool is None else [pool]
+        for key in pools:
+            if key in self.pools:
+                self._dispose(*self.pools.pop(key))
+
+        if self.destination.pool not in self.pools:
+            self.client = None
+            self.write_api = None
+
+    ## Closing client joins its thread pool, do it off the event loop
+    def _dispose(self, client: InfluxDBClient, write_api) -> None:
+        def dispose():
+            try:
+                write_api.close()
+                client.close()
+            except Exception as e:
+                self.logger.error('[InfluxDB] Cannot close client {}. Details {}.'.format(client.url, e))
+
+        threading.Thread(target=dispose, name='influxdb-close', daemon=True).start()
+
+    ## Check if another write can be started, items left failed (no connection) hold new ones back in queue
+    def canWrite(self) -> bool:
+        self._collect()
+        return not self.failed and len(self.inflight) < self.INFLUXDB_MAX_INFLIGHT
+
+    ## Amount of writes in flight
+    def pending(self) -> int:
+        self._collect()
+        return len(self.inflight)
+
+    ## Batch items (topic, records, message) of failed writes, caller passes them to write_batch again
+    def takeFailed(self) -> list:
+        self._collect()
+        failed, self.failed = self.failed, []
+        return failed
+
+    ## Stop tracking pending and failed writes, returns messages they were made of
+    def abandon(self) -> list:
+        items = self.takeFailed()
+        for result, resultItems in self.inflight:
+            items.extend(resultItems)
+        self.inflight.clear()
+        return [message for topic, records, message in items if message is not None]
+
+    ## Forget finished writes, keep batch items of failed ones
+    def _collect(self) -> None:
+        while self.inflight and self.inflight[0][0].ready():
+            result, items = self.inflight.popleft()
+            if result.successful():
+                continue
+
+            try:
+                result.get()
+            except Exception as e:
+                status = getattr(e, 'status', None)
+                if status is not None and 400 <= status < 500 and status != 429:
+                    ## rejected data will be rejected again
+                    self.logger.critical('[InfluxDB] InfluxDB rejected {} items. Details {}.'.format(len(items), e))
+                else:
+                    self.logger.critical('[InfluxDB] Cannot write data into InfluxDB, {} items will be retried. Details {}.'.format(len(items), e))
+                    self.failed.extend(items)
+
+    ## Remember pending write with batch items it was made of
+    def _track(self, results, items: list) -> None:
+        ## write API returns list of results when records have mixed precision
+        if not isinstance(results, list):
+            results = [results]
+
+        for index, result in enumerate(results):
+            self.inflight.append((result, items if index == 0 else []))
+
+    ## Connection pools of all destinations, not connected ones included
+    def poolKeys(self) -> list:
+        keys = []
+        for destination in [self.destination] + [route[2] for route in self.routes]:
+            if destination.pool not in keys:
+                keys.append(destination.pool)
+        return keys
+
+    ## Check health of single server, blocking call
+    def isPoolConnected(self, pool: tuple) -> bool:
+        connection = self.pools.get(pool)
+        if connection is None:
+            return False
+
+        ## health() waits for client timeout (10 seconds), hanging check would hold up exit
         try:
-            health = self.client.health()
-            status = health.status
-            if status == 'pass':
-                return True
-            else:
-                return False    
+            health = HealthService(connection[0].api_client).get_health(_request_timeout=self.INFLUXDB_HEALTH_TIMEOUT * 1000)
+            return health.status == 'pass'
         except Exception as e:
-            self.logger.critical('[InfluxDB] Cannot check InfluxDB status. Details {}.'.format(e)) 
+            self.logger.critical('[InfluxDB] Cannot check InfluxDB {} status. Details {}.'.format(pool[0], e))
             return False
 
+    ## Write records of many topics, one request per destination.
+    ## Batch is list of (topic, records, message), item is kept until write succeeds and
+    ## retried as is, message (None for derived points) is what gets spooled on shutdown.
+    def write_batch(self, batch: list) -> None:
+        destinations = {}
+        for item in batch:
+            destination = self.route(item[0])
+            if destination not in destinations:
+                destinations[destination] = ([], [])
+            records, items = destinations[destination]
+            records.extend(item[1])
+            items.append(item)
 
-    def write_over_api(self, data):
-        if self.client is not None:
-            self.logger.debug('[InfluxDB] Writing InfluxDB point: {}'.format(data))    
+        for destination, (records, items) in destinations.items():
+            pool = self.pools.get(destination.pool)
+            if pool is None:
+                self.logger.critical('[InfluxDB] Cannot write data into InfluxDB {}. No active connections.'.format(destination))
+                self.failed.extend(items)
+                continue
+
+            self.logger.debug('[InfluxDB] Writing {} InfluxDB points to {}'.format(len(records), destination))
             try:
-                self.write_api.write(bucket=self.INFLUXDB_BUCKET, record=data)
+                self._track(pool[1].write(bucket=destination.bucket, org=destination.org, record=records, write_precision=WritePrecision.S), items)
             except Exception as e:
-                self.logger.critical('[InfluxDB] Cannot write data into InfluxDB. Details {}.'.format(e))      
-        else:
-            self.logger.critical('[InfluxDB] Cannot write data into InfluxDB. No active connections.')
\ No newline at end of file
+                self.logger.critical('[InfluxDB] Cannot write data into InfluxDB, {} items will be retried. Details {}.'.format(len(items), e))
+                self.failed.extend(items)
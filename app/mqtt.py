@@ -3,8 +3,8 @@
 
 import os, sys
 import json
+import hashlib
 import logging
-import random
 import paho.mqtt.client
 from typing import Optional
 from app.config import Config
@@ -22,11 +22,6 @@ class MQTTClient(object):
         self.subscriptions = []
         self.MQTT_BROKER_HOST, self.MQTT_BROKER_PORT, self.MQTT_BROKER_USER, self.MQTT_BROKER_PASS, self.MQTT_CLIENT_ID = self._config(config)
 
-    ## Class destructor
-    def __del__(self) -> None:
-        self.disconnect()
-
-
     ## Read module configuration
     def _config(self, config: Config):
         try:
@@ -39,14 +34,22 @@ class MQTTClient(object):
             port = os.getenv('MQTT_PORT', module['port'])
             user = os.getenv('MQTT_AUTH_USER', module['user'])
             password = os.getenv('MQTT_AUTH_PASS', module['password'])
-            client = f'python-mqtt-{random.randint(0, 1000)}'
+            ## client ID must survive restarts, broker keeps session (subscriptions and QoS 1 messages) by it
+            client = os.getenv('MQTT_CLIENT_ID', module.get('client_id')) or self._clientId(host, port, user)
             return host, port, user, password, client
         except Exception as e:
             self.logger.critical('[MQTT] Cannot read configuration for module. Details {}'.format(e))
             sys.exit(1)
 
 
-    ## Close MQTT Broker connection
+    ## Default client ID from broker and user, hostname is container ID and changes when container is recreated
+    def _clientId(self, host: str, port: int, user: str) -> str:
+        digest = hashlib.sha1('{}:{}:{}'.format(host, port, user).encode('utf-8')).hexdigest()
+        client = 'python-mqtt-{}'.format(digest[:12])
+        self.logger.info('[MQTT] Client ID is not configured, using {}. Set client_id when several instances share broker and user.'.format(client))
+        return client
+
+    ## Close MQTT Broker connection, session is kept on broker
     def disconnect(self) -> None:
         if self.client is not None:
             self.client.disconnect()
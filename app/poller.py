@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import random
+import asyncio
+import logging
+import aiohttp
+from app.config import Config
+
+POLLER_CONCURRENCY = 50
+POLLER_INTERVAL = 60
+POLLER_TIMEOUT = 5
+POLLER_SLOW = 2
+POLLER_BACKOFF_MAX = 600
+POLLER_TOPIC = 'tele/{}/SENSOR'
+
+class HTTPPoller(object):
+    """ Poll Tasmota devices over HTTP (STATUS 8) for devices without MQTT access """
+
+    ## Class constructor
+    def __init__(self, logger: logging, config: Config) -> None:
+
+        ## get class name
+        self.module_name = type(self).__name__
+
+        self.session = None
+        self.logger = logger
+        self.POLLER_ENABLED, self.POLLER_CONCURRENCY, self.POLLER_INTERVAL, self.POLLER_TIMEOUT, \
+            self.POLLER_SLOW, self.POLLER_BACKOFF_MAX, self.POLLER_DEVICES = self._config(config)
+
+    ## Read module configuration
+    def _config(self, config: Config):
+        try:
+            ## load configuration, module is optional
+            config = config.modules()
+            module = config.get(self.module_name) or {}
+
+            ## parse configuration
+            enabled = os.getenv('POLLER_ENABLED', module.get('enabled', False))
+            concurrency = int(os.getenv('POLLER_CONCURRENCY', module.get('concurrency', POLLER_CONCURRENCY)))
+            interval = float(os.getenv('POLLER_INTERVAL', module.get('interval', POLLER_INTERVAL)))
+            timeout = float(os.getenv('POLLER_TIMEOUT', module.get('timeout', POLLER_TIMEOUT)))
+            slow = float(os.getenv('POLLER_SLOW', module.get('slow', POLLER_SLOW)))
+            backoff = float(os.getenv('POLLER_BACKOFF_MAX', module.get('backoff_max', POLLER_BACKOFF_MAX)))
+
+            devices = []
+            for device in module.get('devices') or []:
+                devices.append({
+                    'name': device['name'],
+                    'url': device['url'],
+                    'topic': device.get('topic', POLLER_TOPIC.format(device['name'])),
+                    'interval': float(device.get('interval', interval)),
+                })
+
+            return enabled, concurrency, interval, timeout, slow, backoff, devices
+        except Exception as e:
+            self.logger.critical('[POLLER] Cannot read configuration for module. Details {}'.format(e))
+            sys.exit(1)
+
+    ## Check of module enabled
+    def isEnabled(self) -> bool:
+        if self.POLLER_ENABLED and self.POLLER_DEVICES:
+            self.logger.debug('[POLLER] Module is enabled. Module will process request.')
+            return True
+        else:
+            self.logger.debug('[POLLER] Module is disabled. Enable module in config/app.yaml if needed.')
+            return False
+
+    ## Poll all devices until cancelled, results are passed to callback as MQTT messages
+    async def run(self, onMessageCallback) -> None:
+        semaphore = asyncio.Semaphore(self.POLLER_CONCURRENCY)
+        connector = aiohttp.TCPConnector(limit=self.POLLER_CONCURRENCY, keepalive_timeout=self.POLLER_INTERVAL * 2)
+        timeout = aiohttp.ClientTimeout(total=self.POLLER_TIMEOUT)
+
+        self.logger.info('[POLLER] Polling {} devices'.format(len(self.POLLER_DEVICES)))
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            self.session = session
+            try:
+                await asyncio.gather(*[
+                    self.poll(session, semaphore, device, onMessageCallback) for device in self.POLLER_DEVICES
+                ])
+            finally:
+                self.session = None
+
+    ## Fetch sensor state of single device, returns payload and response time
+    async def fetch(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, url: str):
+        loop = asyncio.get_running_loop()
+        async with semaphore:
+            ## time spent waiting for free slot is not device latency
+            started = loop.time()
+            async with session.get(url) as response:
+                response.raise_for_status()
+                content = await response.json(content_type=None)
+            elapsed = loop.time() - started
+
+        ## same payload as tele/<device>/SENSOR message
+        return json.dumps(content['StatusSNS']), elapsed
+
+    ## Poll single device, slow or failing devices are polled less often
+    async def poll(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, device: dict, onMessageCallback) -> None:
+        loop = asyncio.get_running_loop()
+        failures = 0
+
+        ## spread first requests over interval
+        await asyncio.sleep(random.uniform(0, device['interval']))
+
+        while True:
+            started = loop.time()
+            try:
+                payload, elapsed = await self.fetch(session, semaphore, device['url'])
+                onMessageCallback(device['topic'], payload)
+
+                if elapsed > self.POLLER_SLOW:
+                    failures += 1
+                    self.logger.warning('[POLLER] Device {} responded in {:.2f}s.'.format(device['name'], elapsed))
+                else:
+                    failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                failures += 1
+                self.logger.error('[POLLER] Cannot poll device {}. Details {}.'.format(device['name'], repr(error)))
+
+            delay = device['interval']
+            if failures:
+                delay = min(delay * 2 ** min(failures, 16), self.POLLER_BACKOFF_MAX) * random.uniform(0.9, 1.1)
+                self.logger.debug('[POLLER] Device {} next poll in {:.0f}s.'.format(device['name'], delay))
+
+            await asyncio.sleep(max(0, started + delay - loop.time()))
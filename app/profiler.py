@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import io
+import time
+import json
+import pstats
+import asyncio
+import cProfile
+import logging
+import threading
+import traceback
+import tracemalloc
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from app.config import Config
+
+PROFILE_MAX_SECONDS = 300
+PROFILE_DEFAULT_SECONDS = 10
+SAMPLE_DEFAULT_INTERVAL = 0.005
+TRACEMALLOC_DEFAULT_FRAMES = 10
+TRACEMALLOC_DEFAULT_LIMIT = 25
+
+class ProfilerClient(object):
+    """ On-demand runtime profiling over HTTP.
+
+    Nothing is hooked into the interpreter until a request asks for it: cProfile
+    and tracemalloc are only enabled for the duration of a call, and the stack
+    sampler reads frames of the event loop thread from the HTTP thread.
+    """
+
+    ## Class constructor
+    def __init__(self, logger: logging, config: Config) -> None:
+
+        ## get class name
+        self.module_name = type(self).__name__
+
+        self.loop = None
+        self.loopThreadId = None
+        self.server = None
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.PROFILER_HOST, self.PROFILER_PORT, self.PROFILER_ENABLED = self._config(config)
+
+    ## Read module configuration
+    def _config(self, config: Config):
+        try:
+            ## load configuration, module is optional
+            config = config.modules()
+            module = config.get(self.module_name) or {}
+
+            ## parse configuration
+            host = os.getenv('PROFILER_HOST', module.get('host', '127.0.0.1'))
+            port = int(os.getenv('PROFILER_PORT', module.get('port', 9164)))
+            enabled = os.getenv('PROFILER_ENABLED', module.get('enabled', False))
+            return host, port, enabled
+        except Exception as e:
+            self.logger.critical('[PROFILER] Cannot read configuration for module. Details {}'.format(e))
+            sys.exit(1)
+
+    ## Check of module enabled
+    def isEnabled(self) -> bool:
+        if self.PROFILER_ENABLED:
+            self.logger.debug('[PROFILER] Module is enabled. Module will process request.')
+            return True
+        else:
+            self.logger.debug('[PROFILER] Module is disabled. Enable module in config/app.yaml if needed.')
+            return False
+
+    ## Create HTTP endpoint, must be called from the event loop thread
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        self.loop = loop
+        self.loopThreadId = threading.get_ident()
+
+        profiler = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: value[-1] for key, value in parse_qs(url.query).items()}
+                try:
+                    status, body = profiler.dispatch(url.path, query)
+                except Exception as error:
+                    profiler.logger.error('[PROFILER] Request {} failed. Details {}.'.format(self.path, error))
+                    status, body = 500, '{}\n'.format(error)
+
+                content = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                profiler.logger.debug('[PROFILER] ' + format % args)
+
+        self.server = ThreadingHTTPServer((self.PROFILER_HOST, self.PROFILER_PORT), Handler)
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='profiler', daemon=True)
+        thread.start()
+        self.logger.info('[PROFILER] Listening on {}:{}'.format(self.PROFILER_HOST, self.PROFILER_PORT))
+
+    ## Stop HTTP endpoint
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.snapshot = None
+
+    ## Route request to handler
+    def dispatch(self, path: str, query: dict):
+        routes = {
+            '/profile': self.profile,
+            '/sample': self.sample,
+            '/tasks': self.tasks,
+            '/tracemalloc/start': self.tracemallocStart,
+            '/tracemalloc/snapshot': self.tracemallocSnapshot,
+            '/tracemalloc/diff': self.tracemallocDiff,
+            '/tracemalloc/stop': self.tracemallocStop,
+        }
+
+        if path not in routes:
+            return 404, 'Available endpoints: {}\n'.format(', '.join(sorted(routes)))
+
+        return 200, routes[path](query)
+
+    ## Duration of profiling request
+    def _seconds(self, query: dict) -> float:
+        seconds = float(query.get('seconds', PROFILE_DEFAULT_SECONDS))
+        return max(0.0, min(seconds, PROFILE_MAX_SECONDS))
+
+    ## Deterministic profile of the event loop thread, pstats text
+    def profile(self, query: dict) -> str:
+        seconds = self._seconds(query)
+        sort = query.get('sort', 'cumulative')
+        limit = int(query.get('limit', 50))
+
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('Another profiling session is running')
+
+        try:
+            profile = cProfile.Profile()
+            stopped = threading.Event()
+
+            ## profiler must be enabled on the thread it profiles
+            self.loop.call_soon_threadsafe(profile.enable)
+            time.sleep(seconds)
+
+            def disable():
+                profile.disable()
+                stopped.set()
+
+            self.loop.call_soon_threadsafe(disable)
+            if not stopped.wait(timeout=5):
+                raise RuntimeError('Event loop did not respond, profile is incomplete')
+        finally:
+            self.lock.release()
+
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats(sort).print_stats(limit)
+        return stream.getvalue()
+
+    ## Statistical profile of the event loop thread, collapsed stacks
+    def sample(self, query: dict) -> str:
+        seconds = self._seconds(query)
+        interval = max(0.001, float(query.get('interval', SAMPLE_DEFAULT_INTERVAL)))
+
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('Another profiling session is running')
+
+        try:
+            stacks = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(self.loopThreadId)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno))
+                    frame = frame.f_back
+                del frame
+
+                if stack:
+                    stacks[';'.join(reversed(stack))] += 1
+                time.sleep(interval)
+        finally:
+            self.lock.release()
+
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in stacks.most_common())
+
+    ## State of every task scheduled in the event loop
+    def tasks(self, query: dict) -> str:
+        limit = int(query.get('limit', 10))
+
+        async def collect():
+            result = []
+            for task in asyncio.all_tasks():
+                if task.done():
+                    state = 'cancelled' if task.cancelled() else 'finished'
+                else:
+                    state = 'pending'
+
+                result.append({
+                    'name': task.get_name(),
+                    'state': state,
+                    'coroutine': getattr(task.get_coro(), '__qualname__', repr(task.get_coro())),
+                    'stack': [line.rstrip() for line in traceback.StackSummary.extract(
+                        (frame, frame.f_lineno) for frame in task.get_stack(limit=limit)
+                    ).format()],
+                })
+            return result
+
+        future = asyncio.run_coroutine_threadsafe(collect(), self.loop)
+        return json.dumps(sorted(future.result(timeout=5), key=lambda task: task['name']), indent=2) + '\n'
+
+    ## Start tracing memory allocations
+    def tracemallocStart(self, query: dict) -> str:
+        frames = int(query.get('frames', TRACEMALLOC_DEFAULT_FRAMES))
+        if tracemalloc.is_tracing():
+            return 'tracemalloc is already tracing\n'
+
+        tracemalloc.start(frames)
+        self.snapshot = None
+        return 'tracemalloc started with {} frames\n'.format(frames)
+
+    ## Take snapshot, becomes baseline for next diff
+    def tracemallocSnapshot(self, query: dict) -> str:
+        limit = int(query.get('limit', TRACEMALLOC_DEFAULT_LIMIT))
+        key = query.get('key', 'lineno')
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('tracemalloc is not tracing, call /tracemalloc/start first')
+
+        self.snapshot = self._snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = ['current={} peak={}'.format(current, peak)]
+        lines.extend(str(stat) for stat in self.snapshot.statistics(key)[:limit])
+        return '\n'.join(lines) + '\n'
+
+    ## Compare with previous snapshot, new snapshot becomes baseline
+    def tracemallocDiff(self, query: dict) -> str:
+        limit = int(query.get('limit', TRACEMALLOC_DEFAULT_LIMIT))
+        key = query.get('key', 'lineno')
+        if self.snapshot is None:
+            raise RuntimeError('No baseline snapshot, call /tracemalloc/snapshot first')
+
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.snapshot, key)
+        self.snapshot = snapshot
+        return '\n'.join(str(stat) for stat in stats[:limit]) + '\n'
+
+    ## Stop tracing memory allocations
+    def tracemallocStop(self, query: dict) -> str:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.snapshot = None
+        return 'tracemalloc stopped\n'
+
+    ## Snapshot without allocations made by tracemalloc itself
+    def _snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
@@ -3,27 +3,35 @@
 
 import os
 import sys
+import time
 import logging
 import datetime
 from app.config import Config
 from prometheus_client import start_http_server, Counter, Gauge, Summary, Histogram, Info
 
-TOTAL = Gauge('energy_power_total', 'Total consumed electrical network power for all time, kWh', ['measurement', 'deviceclass', 'sensor'])
-YESTERDAY = Gauge('energy_power_yesterday_total', 'Consumed electrical network power for yesterday, kWh', ['measurement', 'deviceclass', 'sensor'])
-TODAY = Gauge('energy_power_today_total', 'Total electrical network consumption power for current day, kWh', ['measurement', 'deviceclass', 'sensor'])
-PERIOD = Gauge('energy_period', 'Consumed electrical network period', ['measurement', 'deviceclass', 'sensor'])
-CURRENT_POWER = Gauge('energy_power_current', 'Current electrical network consumption power, W', ['measurement', 'deviceclass', 'sensor'])
-APPARENT_POWER = Gauge('energy_power_apparent_current', 'Current electrical network apparent power (volt-amperes), VA', ['measurement', 'deviceclass', 'sensor'])
-REACTIVE_POWER = Gauge('energy_power_reactive_current', 'Current electrical network reactive power (volt-amperes), VAr', ['measurement', 'deviceclass', 'sensor'])
-FACTOR = Gauge('energy_power_factor_current', 'Current electrical network power factor (energy loss, cosφ), PF', ['measurement', 'deviceclass', 'sensor'])
-FREQUENCY = Gauge('energy_frequency_current', 'Current electrical network frequency, Hz', ['measurement', 'deviceclass', 'sensor'])
-VOLTAGE = Gauge('energy_voltage_current', 'Current electrical network voltage, V', ['measurement', 'deviceclass', 'sensor'])
-CURRENT = Gauge('energy_amperes_current', 'Current electrical network amperes, A', ['measurement', 'deviceclass', 'sensor'])
-TOTAL_START_TIME = Gauge('energy_device_first_start_timestamp', 'Timestamp of device first start', ['measurement', 'deviceclass', 'sensor'])
-LAST_MEASUREMENT_TIME = Gauge('energy_last_scrape_timestamp', 'Timestamp of lastest measurement', ['measurement', 'deviceclass', 'sensor'])
-SUBSCRIPTION_ID = Gauge('energy_subscription_id', 'Current subscription id', ['measurement', 'deviceclass', 'sensor'])
+TOTAL = Gauge('energy_power_total', 'Total consumed electrical network power for all time, kWh', ['measurement', 'deviceclass', 'sensor', 'device'])
+YESTERDAY = Gauge('energy_power_yesterday_total', 'Consumed electrical network power for yesterday, kWh', ['measurement', 'deviceclass', 'sensor', 'device'])
+TODAY = Gauge('energy_power_today_total', 'Total electrical network consumption power for current day, kWh', ['measurement', 'deviceclass', 'sensor', 'device'])
+PERIOD = Gauge('energy_period', 'Consumed electrical network period', ['measurement', 'deviceclass', 'sensor', 'device'])
+CURRENT_POWER = Gauge('energy_power_current', 'Current electrical network consumption power, W', ['measurement', 'deviceclass', 'sensor', 'device'])
+APPARENT_POWER = Gauge('energy_power_apparent_current', 'Current electrical network apparent power (volt-amperes), VA', ['measurement', 'deviceclass', 'sensor', 'device'])
+REACTIVE_POWER = Gauge('energy_power_reactive_current', 'Current electrical network reactive power (volt-amperes), VAr', ['measurement', 'deviceclass', 'sensor', 'device'])
+FACTOR = Gauge('energy_power_factor_current', 'Current electrical network power factor (energy loss, cosφ), PF', ['measurement', 'deviceclass', 'sensor', 'device'])
+FREQUENCY = Gauge('energy_frequency_current', 'Current electrical network frequency, Hz', ['measurement', 'deviceclass', 'sensor', 'device'])
+VOLTAGE = Gauge('energy_voltage_current', 'Current electrical network voltage, V', ['measurement', 'deviceclass', 'sensor', 'device'])
+CURRENT = Gauge('energy_amperes_current', 'Current electrical network amperes, A', ['measurement', 'deviceclass', 'sensor', 'device'])
+TOTAL_START_TIME = Gauge('energy_device_first_start_timestamp', 'Timestamp of device first start', ['measurement', 'deviceclass', 'sensor', 'device'])
+LAST_MEASUREMENT_TIME = Gauge('energy_last_scrape_timestamp', 'Timestamp of lastest measurement', ['measurement', 'deviceclass', 'sensor', 'device'])
+SUBSCRIPTION_ID = Gauge('energy_subscription_id', 'Current subscription id', ['measurement', 'deviceclass', 'sensor', 'device'])
+QUALITY_EVENTS = Counter('energy_power_quality_events', 'Detected power quality events (voltage sag/swell, frequency drift, load step)', ['measurement', 'deviceclass', 'sensor', 'device', 'event'])
+
+METRICS = [
+    TOTAL, YESTERDAY, TODAY, PERIOD, CURRENT_POWER, APPARENT_POWER, REACTIVE_POWER,
+    FACTOR, FREQUENCY, VOLTAGE, CURRENT, TOTAL_START_TIME, LAST_MEASUREMENT_TIME, SUBSCRIPTION_ID
+]
 
 TOTAL_START_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+SERIES_TTL = 3600
 
 class PrometheusClient(object):
 
@@ -34,7 +42,10 @@ class PrometheusClient(object):
         self.module_name = type(self).__name__
         self.client = None
         self.logger = logger
-        self.EXPORTER_PORT, self.PROMETHEUS_ENABLED = self._config(config)
+        self.lastSeen = {}
+        ## labels of event series of every device, removed together with device series
+        self.eventSeries = {}
+        self.EXPORTER_PORT, self.PROMETHEUS_ENABLED, self.SERIES_TTL = self._config(config)
 
     ## Class destructor
     def __del__(self) -> None:
@@ -50,7 +61,8 @@ class PrometheusClient(object):
             ## parse configuration
             port = os.getenv('PROMETHEUS_EXPORTER_PORT', module['port'])
             enabled = os.getenv('PROMETHEUS_EXPORTER_ENABLED', module['enabled'])
-            return port, enabled
+            ttl = float(os.getenv('PROMETHEUS_SERIES_TTL', module.get('series_ttl', SERIES_TTL)))
+            return port, enabled, ttl
         except Exception as e:
             self.logger.critical('[Prometheus] Cannot read configuration for module. Details {}'.format(e))
             sys.exit(1)
@@ -69,90 +81,139 @@ class PrometheusClient(object):
         self.logger.info('[PROM] Creating client')
         start_http_server(self.EXPORTER_PORT)
 
+    ## Remove series of devices which stopped reporting
+    def evict(self) -> int:
+        if not self.SERIES_TTL:
+            return 0
+
+        deadline = time.monotonic() - self.SERIES_TTL
+        stale = [labels for labels, seen in self.lastSeen.items() if seen < deadline]
+        for labels in stale:
+            self.logger.info('[PROM] Removing idle series {}'.format(labels))
+            for gauge in METRICS:
+                try:
+                    gauge.remove(*labels)
+                except KeyError:
+                    pass
+            for series in self.eventSeries.pop(labels[1:], ()):
+                try:
+                    QUALITY_EVENTS.remove(*series)
+                except KeyError:
+                    pass
+            del self.lastSeen[labels]
+
+        return len(stale)
+
+    ## Count power quality events, finished events are not counted
+    def publishEvents(self, events: list) -> None:
+        for event in events:
+            if event["tags"]["state"] == 'end':
+                continue
+
+            series = (event["measurement"], event["tags"]["class"], event["tags"]["sensor"], event["tags"]["device"], event["tags"]["event"])
+            self.eventSeries.setdefault(series[1:4], set()).add(series)
+            QUALITY_EVENTS.labels(*series).inc()
+
     ## Update metric
     def publish(self, data: list) -> None:
         for metric in data:
+            self.lastSeen[(metric["measurement"], metric["tags"]["class"], metric["tags"]["sensor"], metric["tags"]["device"])] = time.monotonic()
+
             TOTAL.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["total"])
 
             YESTERDAY.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["yesterday"])
 
             TODAY.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["today"])
 
             PERIOD.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["period"])
 
             CURRENT_POWER.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["power"])
 
             APPARENT_POWER.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["apparent_power"])
 
             REACTIVE_POWER.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["reactive_power"])
 
             FACTOR.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["factor"])
 
             FREQUENCY.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["frequency"])
 
             VOLTAGE.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["voltage"])
 
             CURRENT.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["fields"]["current"])
 
             TOTAL_START_TIME.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(round(datetime.datetime.strptime(metric["fields"]["total_start_time"], TOTAL_START_TIME_FORMAT).timestamp()))
 
             LAST_MEASUREMENT_TIME_TIMESTAMP = datetime.datetime.now()
             LAST_MEASUREMENT_TIME.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(round(datetime.datetime.timestamp(LAST_MEASUREMENT_TIME_TIMESTAMP)))
 
             SUBSCRIPTION_ID.labels(
                 measurement = metric["measurement"], 
                 deviceclass = metric["tags"]["class"], 
-                sensor = metric["tags"]["sensor"]
+                sensor = metric["tags"]["sensor"],
+                device = metric["tags"]["device"]
             ).set(metric["tags"]["time_period_id"])
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import math
+import time
+import logging
+from app.config import Config
+from app.sensors.pzem004t import PZEM004TSensor, EnergySensor, SENSOR_CLASS, SENSOR_NAME, topicDevice
+
+EVENTS_MEASUREMENT = 'energy_events'
+
+QUALITY_VOLTAGE = 230
+QUALITY_SAG = 0.9
+QUALITY_SWELL = 1.1
+QUALITY_FREQUENCY = 50
+QUALITY_FREQUENCY_TOLERANCE = 0.5
+QUALITY_LOAD_STEP = 500
+QUALITY_LOAD_DEVIATION = 4
+QUALITY_HYSTERESIS = 0.02
+QUALITY_FREQUENCY_HYSTERESIS = 0.1
+QUALITY_ALPHA = 0.1
+QUALITY_STATE_TTL = 3600
+
+EVENT_SAG = 'sag'
+EVENT_SWELL = 'swell'
+EVENT_FREQUENCY = 'frequency_drift'
+EVENT_LOAD = 'load_step'
+
+class DeviceState(object):
+    """ Constant size state of one device """
+
+    __slots__ = ('voltage', 'frequency', 'frequencyMean', 'powerMean', 'powerVariance', 'samples', 'seen', 'last')
+
+    def __init__(self) -> None:
+        ## active voltage event (sag, swell) or None
+        self.voltage = None
+        ## frequency drift is active
+        self.frequency = False
+        self.frequencyMean = None
+        self.powerMean = None
+        self.powerVariance = 0.0
+        self.samples = 0
+        self.seen = 0.0
+        ## stamp of last analyzed sample
+        self.last = None
+
+class PowerQualityAnalyzer(object):
+    """ Streaming detection of voltage sags/swells, frequency drift and load steps """
+
+    ## Class constructor
+    def __init__(self, logger: logging, config: Config) -> None:
+
+        ## get class name
+        self.module_name = type(self).__name__
+
+        self.logger = logger
+        self.devices = {}
+        self.QUALITY_ENABLED, self.QUALITY_VOLTAGE, self.QUALITY_SAG, self.QUALITY_SWELL, self.QUALITY_FREQUENCY, \
+            self.QUALITY_FREQUENCY_TOLERANCE, self.QUALITY_LOAD_STEP, self.QUALITY_LOAD_DEVIATION, \
+            self.QUALITY_HYSTERESIS, self.QUALITY_FREQUENCY_HYSTERESIS, self.QUALITY_ALPHA, self.QUALITY_STATE_TTL = self._config(config)
+
+        ## enter and exit thresholds
+        self.sagEnter = self.QUALITY_VOLTAGE * self.QUALITY_SAG
+        self.sagExit = self.QUALITY_VOLTAGE * (self.QUALITY_SAG + self.QUALITY_HYSTERESIS)
+        self.swellEnter = self.QUALITY_VOLTAGE * self.QUALITY_SWELL
+        self.swellExit = self.QUALITY_VOLTAGE * (self.QUALITY_SWELL - self.QUALITY_HYSTERESIS)
+        self.frequencyEnter = self.QUALITY_FREQUENCY_TOLERANCE
+        self.frequencyExit = self.QUALITY_FREQUENCY_TOLERANCE - self.QUALITY_FREQUENCY_HYSTERESIS
+
+    ## Read configuration from sensor section, module is optional
+    def _config(self, config: Config):
+        try:
+            ## load configuration
+            config = config.sensors()
+            module = config[PZEM004TSensor.__name__].get('quality') or {}
+
+            ## parse configuration
+            enabled = os.getenv('QUALITY_ENABLED', module.get('enabled', False))
+            voltage = float(module.get('voltage', QUALITY_VOLTAGE))
+            sag = float(module.get('sag', QUALITY_SAG))
+            swell = float(module.get('swell', QUALITY_SWELL))
+            frequency = float(module.get('frequency', QUALITY_FREQUENCY))
+            tolerance = float(module.get('frequency_tolerance', QUALITY_FREQUENCY_TOLERANCE))
+            step = float(module.get('load_step', QUALITY_LOAD_STEP))
+            deviation = float(module.get('load_deviation', QUALITY_LOAD_DEVIATION))
+            hysteresis = float(module.get('hysteresis', QUALITY_HYSTERESIS))
+            frequencyHysteresis = float(module.get('frequency_hysteresis', QUALITY_FREQUENCY_HYSTERESIS))
+            alpha = float(module.get('alpha', QUALITY_ALPHA))
+            ttl = float(os.getenv('QUALITY_STATE_TTL', module.get('state_ttl', QUALITY_STATE_TTL)))
+            return enabled, voltage, sag, swell, frequency, tolerance, step, deviation, hysteresis, frequencyHysteresis, alpha, ttl
+        except Exception as e:
+            self.logger.critical('[QUALITY] Cannot read configuration for module. Details {}'.format(e))
+            sys.exit(1)
+
+    ## Check of module enabled
+    def isEnabled(self) -> bool:
+        if self.QUALITY_ENABLED:
+            self.logger.debug('[QUALITY] Module is enabled. Module will process request.')
+            return True
+        else:
+            self.logger.debug('[QUALITY] Module is disabled. Enable module in config/app.yaml if needed.')
+            return False
+
+    ## Analyze sensor decoded by PZEM004TSensor, values are taken before truncation of points
+    def analyze(self, topic: str, sensor: EnergySensor, stamp: int = None) -> list:
+        energy = sensor.energy
+        return self.observe(topicDevice(topic), stamp, float(energy.voltage), float(energy.frequency), float(energy.power))
+
+    ## Analyze columns produced by PZEM004TBatch.decode, returns list of (topic, events)
+    def analyzeColumns(self, columns: dict) -> list:
+        batch = []
+        raw = columns['raw']
+        rows = zip(
+            columns['topic'], columns['time'].tolist(),
+            raw['voltage'].tolist(), raw['frequency'].tolist(), raw['power'].tolist()
+        )
+        for topic, stamp, voltage, frequency, power in rows:
+            events = self.observe(topicDevice(topic), stamp, voltage, frequency, power)
+            if events:
+                batch.append((topic, events))
+        return batch
+
+    ## Forget state of devices which stopped reporting
+    def evict(self) -> int:
+        if not self.QUALITY_STATE_TTL:
+            return 0
+
+        deadline = time.monotonic() - self.QUALITY_STATE_TTL
+        stale = [device for device, state in self.devices.items() if state.seen < deadline]
+        for device in stale:
+            del self.devices[device]
+
+        if stale:
+            self.logger.debug('[QUALITY] Removed state of {} idle devices'.format(len(stale)))
+        return len(stale)
+
+    ## Update device state with one sample, returns started and finished events
+    def observe(self, device: str, stamp: int, voltage: float, frequency: float, power: float) -> list:
+        state = self.devices.get(device)
+        if state is None:
+            state = self.devices[device] = DeviceState()
+        state.seen = time.monotonic()
+
+        ## sample already analyzed (retried, replayed from spool) or older than last one
+        if stamp is not None and state.last is not None and stamp <= state.last:
+            return []
+        if stamp is not None:
+            state.last = stamp
+
+        events = []
+        alpha = self.QUALITY_ALPHA
+
+        ## voltage sag and swell on instant value
+        if state.voltage == EVENT_SAG and voltage > self.sagExit:
+            events.append(self.event(device, stamp, EVENT_SAG, 'end', voltage, self.QUALITY_VOLTAGE))
+            state.voltage = None
+        elif state.voltage == EVENT_SWELL and voltage < self.swellExit:
+            events.append(self.event(device, stamp, EVENT_SWELL, 'end', voltage, self.QUALITY_VOLTAGE))
+            state.voltage = None
+
+        if state.voltage is None:
+            if voltage < self.sagEnter:
+                state.voltage = EVENT_SAG
+            elif voltage > self.swellEnter:
+                state.voltage = EVENT_SWELL
+            if state.voltage is not None:
+                events.append(self.event(device, stamp, state.voltage, 'start', voltage, self.QUALITY_VOLTAGE))
+
+        ## frequency drift on smoothed value
+        if state.frequencyMean is None:
+            state.frequencyMean = frequency
+        else:
+            state.frequencyMean += alpha * (frequency - state.frequencyMean)
+
+        drift = abs(state.frequencyMean - self.QUALITY_FREQUENCY)
+        if not state.frequency and drift > self.frequencyEnter:
+            state.frequency = True
+            events.append(self.event(device, stamp, EVENT_FREQUENCY, 'start', state.frequencyMean, self.QUALITY_FREQUENCY))
+        elif state.frequency and drift < self.frequencyExit:
+            state.frequency = False
+            events.append(self.event(device, stamp, EVENT_FREQUENCY, 'end', state.frequencyMean, self.QUALITY_FREQUENCY))
+
+        ## load step against exponentially weighted mean and variance
+        if state.powerMean is None:
+            state.powerMean = power
+        else:
+            delta = power - state.powerMean
+            threshold = max(self.QUALITY_LOAD_STEP, self.QUALITY_LOAD_DEVIATION * math.sqrt(state.powerVariance))
+            if state.samples > 1 and abs(delta) > threshold:
+                events.append(self.event(device, stamp, EVENT_LOAD, 'up' if delta > 0 else 'down', power, state.powerMean))
+                ## new load level becomes baseline
+                state.powerMean = power
+                state.powerVariance = 0.0
+            else:
+                state.powerMean += alpha * delta
+                state.powerVariance = (1 - alpha) * (state.powerVariance + alpha * delta * delta)
+
+        state.samples += 1
+        return events
+
+    ## Event point in the format of PZEM004TSensor.get
+    def event(self, device: str, stamp: int, kind: str, state: str, value: float, reference: float) -> dict:
+        self.logger.info('[QUALITY] Device {} {} {}: value {}, reference {}'.format(device, kind, state, value, reference))
+
+        event = {
+            'measurement': EVENTS_MEASUREMENT,
+            'tags': {
+                'class': SENSOR_CLASS,
+                'sensor': SENSOR_NAME,
+                'device': device,
+                'event': kind,
+                'state': state,
+            },
+            'fields': {
+                'value': float(value),
+                'reference': float(reference),
+            },
+        }
+
+        if stamp is not None:
+            event['time'] = stamp
+        return event
@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 import json
+import math
+import numpy as np
 from datetime import *
 from app.config import Config
 
@@ -10,7 +12,34 @@ SENSOR_NAME = 'pzem004t'
 SENSOR_MEASUREMENT = 'energy'
 SENSOR_MQTT_TOPIC = 'tele/pzem004tv3_87A0B8/SENSOR'
 
-#PZEM004_URL = 'http://192.168.0.176/cm?cmnd=STATUS+8'
+#PZEM004_URL = 'http://192.168.0.176/cm?cmnd=STATUS+8' # polled by app.poller.HTTPPoller
+
+SENSOR_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+SCHEDULE_UNDEFINED = 'undefined'
+SECONDS_PER_DAY = 86400
+## seconds of day of malformed sensor time, row is dropped
+SECONDS_INVALID = -1
+DEVICES_CACHE_SIZE = 65536
+
+## (payload key, field name, type) in the order of Energy.toDictionary
+ENERGY_FIELDS = [
+    ('Total', 'total', float),
+    ('Yesterday', 'yesterday', float),
+    ('Today', 'today', float),
+    ('Period', 'period', int),
+    ('Power', 'power', int),
+    ('ApparentPower', 'apparent_power', int),
+    ('ReactivePower', 'reactive_power', int),
+    ('Factor', 'factor', float),
+    ('Frequency', 'frequency', int),
+    ('Voltage', 'voltage', int),
+    ('Current', 'current', float),
+]
+
+## fields Tasmota omits from ENERGY, e.g. Period outside of telemetry period (STATUS 8)
+ENERGY_DEFAULTS = {
+    'Period': 0,
+}
 
 class Esp32(object):
     def __init__(self, Temperature: float) -> None:
@@ -70,7 +99,7 @@ class EnergySensor(object):
 
     def __init__(self, Time: str, ENERGY: Energy, ESP32: Esp32, TempUnit: str) -> None:
         self.time = Time
-        self.energy = Energy(**ENERGY)
+        self.energy = Energy(**dict(ENERGY_DEFAULTS, **ENERGY))
         self.esp32 = Esp32(**ESP32)
         self.tempUnit = TempUnit
 
@@ -115,7 +144,7 @@ class EnergySensor(object):
         cfg = config
         schedules = cfg['schedule']
 
-        sensorTime = datetime.strptime(self.getTime(), "%Y-%m-%dT%H:%M:%S")
+        sensorTime = datetime.strptime(self.getTime(), SENSOR_TIME_FORMAT)
         timeOfMeasurement = "{}:{}:{}".format(sensorTime.hour, sensorTime.minute, sensorTime.second)
 
         for schedule in schedules:
@@ -135,8 +164,9 @@ class EnergySensor(object):
                     if self.ifDateIsBetween(condition['after'], condition['before'], timeOfMeasurement):
                         scheduleId = list(schedules).index(scheduleName)
                         return scheduleName, scheduleId
-                else:
-                    return "undefined"
+
+        ## time between schedules, e.g. 06:59:59 when t2 ends before 06:59:59
+        return SCHEDULE_UNDEFINED, -1
 
 
 class PZEM004TSensor():
@@ -152,7 +182,7 @@ class PZEM004TSensor():
         self.sensor = EnergySensor(**dictionary)
 
 
-    def get(self, config: Config):
+    def get(self, config: Config, topic: str = None, received: float = None):
         ## get class name
         self.module_name = type(self).__name__
 
@@ -167,6 +197,7 @@ class PZEM004TSensor():
 
         tags['class'] = SENSOR_CLASS
         tags['sensor'] = SENSOR_NAME
+        tags['device'] = topicDevice(topic or SENSOR_MQTT_TOPIC)
 
         time_period_name, time_period_id = self.sensor.getSubscriptionType(config)
 
@@ -177,5 +208,197 @@ class PZEM004TSensor():
         response['tags'] = tags
         response['fields'] = self.sensor.getEnergy()
 
+        ## device clock has no zone, point is stamped with receive time, seconds precision
+        response['time'] = round(received if received is not None else datetime.now().timestamp())
+
         payload.append(response)
-        return payload
\ No newline at end of file
+        return payload
+
+
+class PZEM004TBatch():
+    """ Column oriented processing of many sensor messages at once.
+
+    Produces the same points as PZEM004TSensor.get, rendered as line protocol.
+    """
+
+    def __init__(self, config: Config) -> None:
+
+        ## get class name of sensor configuration
+        self.module_name = PZEM004TSensor.__name__
+
+        sensorsConfig = config.sensors()
+        self.names, self.schedule = self.compileSchedule(sensorsConfig[self.module_name])
+
+        ## tags are the same for every point except device and time period
+        self.tags = '{},class={},sensor={},device='.format(
+            escapeKey(SENSOR_MEASUREMENT), escapeKey(SENSOR_CLASS), escapeKey(SENSOR_NAME)
+        )
+        self.prefixes = [
+            ',time_period={},time_period_id={} '.format(escapeKey(name), index)
+            for index, name in enumerate(self.names)
+        ]
+        self.prefixes.append(',time_period={},time_period_id=-1 '.format(SCHEDULE_UNDEFINED))
+
+        ## escaped device tag of every topic seen
+        self.devices = {}
+
+        fields = []
+        for _, field, kind in ENERGY_FIELDS:
+            fields.append('{}={{}}{}'.format(field, 'i' if kind is int else ''))
+        self.template = self.tags + '{}{}' + ','.join(['total_start_time="{}"'] + fields) + ' {}'
+
+    ## Build lookup table of schedule id for every second of day, first matching condition wins
+    def compileSchedule(self, config: dict):
+        schedules = config['schedule']
+        names = list(schedules)
+        table = np.full(SECONDS_PER_DAY, -1, dtype=np.int16)
+        seconds = np.arange(SECONDS_PER_DAY)
+
+        for index in reversed(range(len(names))):
+            for condition in reversed(schedules[names[index]]['conditions']):
+                if type(condition) is not dict:
+                    continue
+
+                start = secondsOfDay(condition['after'])
+                end = secondsOfDay(condition['before'])
+                if start <= end:
+                    mask = (start <= seconds) & (seconds < end)
+                else: # over midnight e.g., 23:30-04:15
+                    mask = (start <= seconds) | (seconds < end)
+                table[mask] = index
+
+        return names, table
+
+    ## Decode (topic, payload, received) messages into columns, malformed messages are skipped
+    def decode(self, messages: list) -> dict:
+        decoded = []
+        topics = []
+        times = []
+        starts = []
+        seconds = []
+        values = [[] for _ in ENERGY_FIELDS]
+
+        for item in messages:
+            try:
+                topic, message, received = item
+                sensor = json.loads(message)
+                energy = dict(ENERGY_DEFAULTS, **sensor['ENERGY'])
+                row = [energy[key] for key, _, _ in ENERGY_FIELDS]
+                if not all(type(value) in (int, float) and math.isfinite(value) for value in row):
+                    continue
+
+                second = sensorSeconds(sensor['Time'])
+                start = energy['TotalStartTime']
+                if type(start) is not str:
+                    continue
+                stamp = round(received)
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            decoded.append(item)
+            topics.append(topic)
+            times.append(stamp)
+            seconds.append(second)
+            starts.append(start)
+            for column, value in zip(values, row):
+                column.append(value)
+
+        ## rows with malformed sensor time are dropped at once
+        seconds = np.asarray(seconds, dtype=np.int64)
+        valid = seconds != SECONDS_INVALID
+        if not valid.all():
+            keep = valid.tolist()
+            decoded = [item for item, kept in zip(decoded, keep) if kept]
+            topics = [topic for topic, kept in zip(topics, keep) if kept]
+            starts = [start for start, kept in zip(starts, keep) if kept]
+            seconds = seconds[valid]
+
+        columns = {}
+        columns['message'] = decoded
+        columns['topic'] = topics
+        columns['total_start_time'] = starts
+        ## values before truncation, e.g. 49.98 Hz for power quality analysis
+        columns['raw'] = {}
+        for (_, field, kind), column in zip(ENERGY_FIELDS, values):
+            raw = columns['raw'][field] = np.asarray(column, dtype=np.float64)[valid]
+            ## truncate like int() in Energy.toDictionary
+            columns[field] = raw.astype(np.int64) if kind is int else raw
+
+        ## schedule follows device wall clock, point is stamped with receive time like PZEM004TSensor.get
+        columns['time_period_id'] = self.schedule[seconds].astype(np.int64)
+        columns['time'] = np.asarray(times, dtype=np.int64)[valid]
+        return columns
+
+    ## Render line protocol of all points, returns list of (topic, [line], message)
+    def toLineProtocol(self, columns: dict) -> list:
+        devices = [self.device(topic) for topic in columns['topic']]
+        prefixes = [self.prefixes[index] for index in columns['time_period_id'].tolist()]
+        starts = [value.replace('\\', '\\\\').replace('"', '\\"') for value in columns['total_start_time']]
+        fields = [columns[field].tolist() for _, field, _ in ENERGY_FIELDS]
+
+        template = self.template.format
+        lines = [template(*row) for row in zip(devices, prefixes, starts, *fields, columns['time'].tolist())]
+        return [(topic, [line], message) for topic, line, message in zip(columns['topic'], lines, columns['message'])]
+
+    ## Escaped device tag of topic
+    def device(self, topic: str) -> str:
+        device = self.devices.get(topic)
+        if device is None:
+            if len(self.devices) >= DEVICES_CACHE_SIZE:
+                self.devices.clear()
+            device = self.devices[topic] = escapeKey(topicDevice(topic))
+        return device
+
+    ## Latest point of every topic in the format of PZEM004TSensor.get
+    def latest(self, columns: dict) -> list:
+        rows = {}
+        for index, topic in enumerate(columns['topic']):
+            rows[topic] = index
+
+        payload = []
+        for topic, index in rows.items():
+            period = int(columns['time_period_id'][index])
+            fields = {'total_start_time': columns['total_start_time'][index]}
+            for _, field, kind in ENERGY_FIELDS:
+                fields[field] = kind(columns[field][index])
+
+            payload.append({
+                'measurement': SENSOR_MEASUREMENT,
+                'tags': {
+                    'class': SENSOR_CLASS,
+                    'sensor': SENSOR_NAME,
+                    'device': topicDevice(topic),
+                    'time_period': self.names[period] if period >= 0 else SCHEDULE_UNDEFINED,
+                    'time_period_id': period,
+                },
+                'fields': fields,
+                'time': int(columns['time'][index]),
+            })
+        return payload
+
+
+## Get device name from Tasmota topic, e.g. tele/<device>/SENSOR
+def topicDevice(topic: str) -> str:
+    parts = topic.split('/')
+    return parts[-2] if len(parts) >= 3 else topic
+
+## Seconds since midnight of sensor time (YYYY-MM-DDTHH:MM:SS), SECONDS_INVALID when malformed
+def sensorSeconds(value: str) -> int:
+    if type(value) is not str or len(value) != 19 or value[10] != 'T' or value[13] != ':' or value[16] != ':':
+        return SECONDS_INVALID
+    try:
+        hours, minutes, seconds = int(value[11:13]), int(value[14:16]), int(value[17:19])
+    except ValueError:
+        return SECONDS_INVALID
+    if not (0 <= hours < 24 and 0 <= minutes < 60 and 0 <= seconds < 60):
+        return SECONDS_INVALID
+    return hours * 3600 + minutes * 60 + seconds
+
+## Seconds since midnight of HH:MM:SS string
+def secondsOfDay(value: str) -> int:
+    hours, minutes, seconds = value.split(':')
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+## Escape tag key or value for line protocol
+def escapeKey(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Batch benchmark: decode and render sensor messages one by one (PZEM004TSensor.get
+and line protocol of influxdb_client) and in columns (PZEM004TBatch), for batches
+of 1, 100 and 10,000 messages. Both paths must produce the same points.
+
+    $ python3 benchmarks/batch.py --sizes 1 100 10000
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from influxdb_client import Point, WritePrecision
+from app.config import Config
+from app.sensors.pzem004t import PZEM004TSensor, PZEM004TBatch
+
+SCHEDULE = {
+    't1': {'conditions': [{'after': '07:00:00', 'before': '22:59:59'}]},
+    't2': {'conditions': [{'after': '00:00:01', 'before': '06:59:59'}, {'after': '23:00:00', 'before': '00:00:00'}]},
+}
+
+def messages(count: int, devices: int) -> list:
+    rng = random.Random(count)
+    result = []
+    for index in range(count):
+        ## every second of day, schedule gaps included
+        second = index * 7919 % 86400
+        result.append(('tele/device{}/SENSOR'.format(index % devices), json.dumps({
+            'Time': '2022-10-17T{:02d}:{:02d}:{:02d}'.format(second // 3600, second // 60 % 60, second % 60),
+            'ENERGY': {
+                'TotalStartTime': '2022-01-01T00:00:00', 'Total': round(rng.uniform(0, 1e4), 3),
+                'Yesterday': round(rng.uniform(0, 30), 3), 'Today': round(rng.uniform(0, 30), 3), 'Period': rng.randint(0, 50),
+                'Power': rng.randint(0, 3000), 'ApparentPower': rng.randint(0, 3000), 'ReactivePower': rng.randint(0, 500),
+                'Factor': round(rng.uniform(0, 1), 2), 'Frequency': round(rng.uniform(49.8, 50.2), 2),
+                'Voltage': round(rng.uniform(210, 245), 1), 'Current': round(rng.uniform(0, 13), 3),
+            },
+            'ESP32': {'Temperature': 40.0},
+            'TempUnit': 'C',
+        }), 1666000000 + index * 0.7))
+    return result
+
+def scalar(config: Config, batch: list) -> list:
+    lines = []
+    for topic, payload, received in batch:
+        for point in PZEM004TSensor(payload).get(config, topic, received):
+            lines.append(Point.from_dict(point, write_precision=WritePrecision.S).to_line_protocol())
+    return lines
+
+def columns(batcher: PZEM004TBatch, batch: list) -> list:
+    return [line for _, lines, _ in batcher.toLineProtocol(batcher.decode(batch)) for line in lines]
+
+## Same point rendered by both paths, tag and field order and float format (1 or 1.0) may differ
+def parse(line: str) -> tuple:
+    head, fields, stamp = line.split(' ')
+    measurement, *tags = head.split(',')
+    values = []
+    for field in fields.split(','):
+        key, value = field.split('=', 1)
+        values.append((key, value if value.startswith('"') or value.endswith('i') else float(value)))
+    return measurement, sorted(tags), sorted(values), stamp
+
+def measure(function, repeat: int) -> tuple:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return time.perf_counter() - started, result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000])
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000, help='messages processed per size')
+    args = parser.parse_args()
+
+    config = Config(logging, os.getcwd())
+    config.sensorsConfigCache = {'PZEM004TSensor': {'schedule': SCHEDULE}}
+    batcher = PZEM004TBatch(config)
+
+    print('{:>8} {:>14} {:>14} {:>8}'.format('size', 'scalar us/msg', 'batch us/msg', 'speedup'))
+    for size in args.sizes:
+        batch = messages(size, args.devices)
+        repeat = max(1, args.messages // size)
+
+        scalarTime, scalarLines = measure(lambda: scalar(config, batch), repeat)
+        batchTime, batchLines = measure(lambda: columns(batcher, batch), repeat)
+        assert [parse(line) for line in scalarLines] == [parse(line) for line in batchLines], 'paths produce different points'
+
+        total = size * repeat
+        print('{:>8} {:>14.2f} {:>14.2f} {:>7.1f}x'.format(
+            size, scalarTime / total * 1e6, batchTime / total * 1e6, scalarTime / batchTime))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Poller benchmark: poll a fleet of simulated Tasmota devices over HTTP (STATUS 8)
+with mixed response times and failures, and check that every responsive device
+is polled on time while slow and dead ones back off.
+
+    $ python3 benchmarks/poller.py --devices 500 --seconds 30
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+from collections import Counter
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.config import Config
+from app.poller import HTTPPoller
+from app.sensors.pzem004t import PZEM004TBatch
+
+SCHEDULE = {
+    't1': {'conditions': [{'after': '07:00:00', 'before': '23:00:00'}]},
+    't2': {'conditions': [{'after': '23:00:00', 'before': '07:00:00'}]},
+}
+
+## Tasmota answer to STATUS 8, ENERGY has no Period outside of telemetry period
+def status(index: int) -> dict:
+    return {'StatusSNS': {
+        'Time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'ENERGY': {
+            'TotalStartTime': '2022-01-01T00:00:00', 'Total': 10.0 + index, 'Yesterday': 1.0, 'Today': 2.0,
+            'Power': 100 + index % 50, 'ApparentPower': 110, 'ReactivePower': 10, 'Factor': 0.9,
+            'Frequency': 50, 'Voltage': 230, 'Current': 0.5,
+        },
+        'ESP32': {'Temperature': 40.0},
+        'TempUnit': 'C',
+    }}
+
+## Device profiles: response time in seconds, None is a device which does not answer
+def profiles(devices: int, slowShare: float, deadShare: float) -> list:
+    rng = random.Random(1)
+    result = []
+    for index in range(devices):
+        draw = rng.random()
+        if draw < deadShare:
+            result.append(None)
+        elif draw < deadShare + slowShare:
+            result.append(rng.uniform(2.5, 4))
+        else:
+            result.append(rng.uniform(0.01, 0.3))
+    return result
+
+async def serve(latencies: list):
+    async def handler(request):
+        index = int(request.match_info['name'][1:])
+        latency = latencies[index]
+        if latency is None:
+            raise web.HTTPServiceUnavailable()
+        await asyncio.sleep(latency)
+        return web.json_response(status(index))
+
+    app = web.Application()
+    app.router.add_get('/{name}/cm', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+## Largest delay of event loop wake up
+async def lag(samples: list) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(0.05)
+        samples.append(loop.time() - started - 0.05)
+
+async def run(args) -> tuple:
+    latencies = profiles(args.devices, args.slow, args.dead)
+    runner, port = await serve(latencies)
+
+    config = Config(logging, os.getcwd())
+    config.modulesConfigCache = {'HTTPPoller': {
+        'enabled': True, 'interval': args.interval, 'concurrency': args.concurrency, 'timeout': 5, 'slow': 2,
+        'devices': [{'name': 'd{}'.format(index), 'url': 'http://127.0.0.1:{}/d{}/cm?cmnd=STATUS+8'.format(port, index)}
+                    for index in range(args.devices)],
+    }}
+    config.sensorsConfigCache = {'PZEM004TSensor': {'schedule': SCHEDULE}}
+    poller = HTTPPoller(logging, config)
+
+    messages = []
+    lags = []
+    tasks = [asyncio.ensure_future(poller.run(lambda topic, payload: messages.append((topic, payload, time.time())))), asyncio.ensure_future(lag(lags))]
+    await asyncio.sleep(args.seconds)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await runner.cleanup()
+    return latencies, messages, lags, config
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--interval', type=float, default=5, help='poll interval, seconds')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--slow', type=float, default=0.05, help='share of devices answering slower than 2 seconds')
+    parser.add_argument('--dead', type=float, default=0.02, help='share of devices not answering')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+    latencies, messages, lags, config = asyncio.run(run(args))
+
+    polls = Counter(topic.split('/')[1] for topic, _, _ in messages)
+    healthy = [index for index, latency in enumerate(latencies) if latency is not None and latency < 2]
+    slow = [index for index, latency in enumerate(latencies) if latency is not None and latency >= 2]
+    dead = [index for index, latency in enumerate(latencies) if latency is None]
+
+    ## first poll is spread over one interval
+    expected = int(args.seconds / args.interval) - 1
+    late = [index for index in healthy if polls['d{}'.format(index)] < expected]
+    perSlow = sum(polls['d{}'.format(index)] for index in slow) / max(len(slow), 1)
+    perHealthy = sum(polls['d{}'.format(index)] for index in healthy) / max(len(healthy), 1)
+
+    started = time.perf_counter()
+    columns = PZEM004TBatch(config).decode(messages)
+    decoded = time.perf_counter() - started
+
+    lags.sort()
+    print('{} devices ({} healthy, {} slow, {} dead), {} polls in {:.0f}s ({:.1f}/s)'.format(
+        args.devices, len(healthy), len(slow), len(dead), len(messages), args.seconds, len(messages) / args.seconds))
+    print('polls per device: healthy {:.1f} (expected >= {}), slow {:.1f}'.format(perHealthy, expected, perSlow))
+    print('event loop lag: p50 {:.1f} ms, max {:.1f} ms'.format(lags[len(lags) // 2] * 1e3, lags[-1] * 1e3))
+    print('decoded {} of {} messages in {:.1f} ms'.format(len(columns['topic']), len(messages), decoded * 1e3))
+
+    assert not late, '{} healthy devices polled less than {} times'.format(len(late), expected)
+    assert not any(polls['d{}'.format(index)] for index in dead), 'dead devices produced messages'
+    assert len(columns['topic']) == len(messages), 'messages without Period were not decoded'
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Power quality benchmark: stream telemetry of a fleet through PowerQualityAnalyzer,
+one message at a time and in column batches. Every device has injected sags,
+frequency drifts and load steps, all of them must be detected.
+
+    $ python3 benchmarks/quality.py --devices 1000 --rounds 100
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tracemalloc
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.config import Config
+from app.quality import PowerQualityAnalyzer
+from app.sensors.pzem004t import PZEM004TSensor, PZEM004TBatch
+
+SCHEDULE = {
+    't1': {'conditions': [{'after': '00:00:00', 'before': '12:00:00'}]},
+    't2': {'conditions': [{'after': '12:00:00', 'before': '00:00:00'}]},
+}
+
+## Round of one message per device, device index selects when its events happen
+def fleet(devices: int, rounds: int) -> list:
+    rng = random.Random(1)
+    result = []
+    for step in range(rounds):
+        messages = []
+        for index in range(devices):
+            phase = (step + index) % 50
+            voltage = 195.0 if phase == 10 else round(230 + rng.uniform(-2, 2), 1)
+            frequency = 50.9 if 20 <= phase < 35 else round(49.98 + rng.uniform(-0.03, 0.03), 2)
+            power = (1500 if phase >= 40 else 200) + rng.randint(-10, 10)
+            messages.append(('tele/device{}/SENSOR'.format(index), json.dumps({
+                'Time': '2022-10-17T12:00:00',
+                'ENERGY': {
+                    'TotalStartTime': '2022-01-01T00:00:00', 'Total': 10.0, 'Yesterday': 1.0, 'Today': 2.0, 'Period': 1,
+                    'Power': power, 'ApparentPower': power + 10, 'ReactivePower': 10, 'Factor': 0.9,
+                    'Frequency': frequency, 'Voltage': voltage, 'Current': 0.5,
+                },
+                'ESP32': {'Temperature': 40.0},
+                'TempUnit': 'C',
+            }), 1666000000 + step * 10))
+        result.append(messages)
+    return result
+
+def makeConfig() -> Config:
+    config = Config(logging, os.getcwd())
+    config.sensorsConfigCache = {'PZEM004TSensor': {'schedule': SCHEDULE, 'quality': {'enabled': True}}}
+    return config
+
+def scalar(config: Config, rounds: list) -> tuple:
+    analyzer = PowerQualityAnalyzer(logging, config)
+    sensors = [[(topic, PZEM004TSensor(payload).sensor, round(received)) for topic, payload, received in messages] for messages in rounds]
+
+    events = []
+    started = time.perf_counter()
+    for messages in sensors:
+        for topic, sensor, stamp in messages:
+            events.extend(analyzer.analyze(topic, sensor, stamp))
+    return time.perf_counter() - started, events, analyzer
+
+def columns(config: Config, rounds: list) -> tuple:
+    analyzer = PowerQualityAnalyzer(logging, config)
+    batch = PZEM004TBatch(config)
+    decoded = [batch.decode(messages) for messages in rounds]
+
+    events = []
+    started = time.perf_counter()
+    for columns in decoded:
+        for topic, deviceEvents in analyzer.analyzeColumns(columns):
+            events.extend(deviceEvents)
+    return time.perf_counter() - started, events, analyzer
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=100)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    config = makeConfig()
+    rounds = fleet(args.devices, args.rounds)
+    messages = args.devices * args.rounds
+
+    scalarTime, scalarEvents, _ = scalar(config, rounds)
+    batchTime, batchEvents, analyzer = columns(config, rounds)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    state = PowerQualityAnalyzer(logging, config)
+    for index in range(args.devices):
+        state.observe('device{}'.format(index), None, 230.0, 50.0, 200.0)
+    perDevice = (tracemalloc.get_traced_memory()[0] - before) / args.devices
+    tracemalloc.stop()
+
+    kinds = Counter((event['tags']['event'], event['tags']['state']) for event in batchEvents)
+    print('{} devices, {} messages, {} events: {}'.format(
+        args.devices, messages, len(batchEvents), ', '.join('{} {} {}'.format(count, *kind) for kind, count in sorted(kinds.items()))))
+    print('analyze: scalar {:.2f} us/message, columns {:.2f} us/message'.format(scalarTime / messages * 1e6, batchTime / messages * 1e6))
+    print('state: {:.0f} bytes per device'.format(perDevice))
+
+    key = lambda event: (event['tags']['device'], event['time'], event['tags']['event'], event['tags']['state'])
+    assert sorted(map(key, scalarEvents)) == sorted(map(key, batchEvents)), 'scalar and column paths detect different events'
+
+    ## every device passes injected sag and drift and at least one load step up
+    for kind in (('sag', 'start'), ('frequency_drift', 'start'), ('load_step', 'up')):
+        devices = {event['tags']['device'] for event in batchEvents if (event['tags']['event'], event['tags']['state']) == kind}
+        assert len(devices) == args.devices, '{} {} detected on {} of {} devices'.format(*kind, len(devices), args.devices)
+    assert len(analyzer.devices) == args.devices
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Routing benchmark: fleet of devices routed to many organizations and buckets
+of a local InfluxDB stand-in, measures route lookup, write throughput and
+health checks of every connection pool.
+
+    $ python3 benchmarks/routing.py --devices 1000 --orgs 10 --buckets 5
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.config import Config
+from app.influxdb import InfluxClient
+
+HEALTH = json.dumps({'name': 'influxdb', 'message': 'ready for queries and writes', 'status': 'pass', 'checks': [], 'version': 'stand-in', 'commit': '0'})
+
+class InfluxStandIn(object):
+    """ InfluxDB v2 write and health endpoints, counts received lines per org and bucket """
+
+    def __init__(self, latency: float) -> None:
+        self.lines = Counter()
+        self.requests = 0
+        self.lock = threading.Lock()
+        standIn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                query = {key: value[-1] for key, value in parse_qs(url.query).items()}
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(latency)
+                with standIn.lock:
+                    standIn.lines[(query.get('org'), query.get('bucket'))] += body.count(b'\n') + 1
+                    standIn.requests += 1
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                content = HEALTH.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+def makeConfig(url: str, orgs: int, buckets: int) -> Config:
+    routes = []
+    for index in range(orgs * buckets):
+        routes.append({
+            'match': {'device': 'room{}_*'.format(index)},
+            'org': 'org{}'.format(index // buckets),
+            'bucket': 'bucket{}'.format(index % buckets),
+        })
+
+    config = Config(logging, os.getcwd())
+    config.modulesConfigCache = {'InfluxClient': {
+        'url': url, 'token': 't', 'org': 'home', 'bucket': 'monitoring', 'enabled': True,
+        'max_inflight': 100000, 'routes': routes,
+    }}
+    return config
+
+def line(device: str, index: int) -> str:
+    return 'energy,class=energy,sensor=pzem004t,device={} power={}i {}'.format(device, index, 1666000000 + index)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=1000)
+    parser.add_argument('--orgs', type=int, default=10)
+    parser.add_argument('--buckets', type=int, default=5, help='buckets per organization')
+    parser.add_argument('--rounds', type=int, default=20, help='messages per device')
+    parser.add_argument('--latency', type=float, default=0.005, help='stand-in response time, seconds')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    standIn = InfluxStandIn(args.latency)
+    destinations = args.orgs * args.buckets
+    topics = ['tele/room{}_{}/SENSOR'.format(index % destinations, index) for index in range(args.devices)]
+
+    client = InfluxClient(logging, makeConfig(standIn.url, args.orgs, args.buckets))
+    client.connect()
+    print('{} routes, {} connection pools, {} devices'.format(len(client.routes), len(client.pools), args.devices))
+
+    ## first lookup matches rules, next ones are cached
+    started = time.perf_counter()
+    for topic in topics:
+        client.route(topic)
+    cold = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for _ in range(args.rounds):
+        for topic in topics:
+            client.route(topic)
+    warm = time.perf_counter() - started
+    print('route lookup: cold {:.2f} us, cached {:.3f} us'.format(
+        cold / len(topics) * 1e6, warm / (len(topics) * args.rounds) * 1e6))
+
+    ## one write_batch per round, same as one processQueue pass over whole fleet
+    started = time.perf_counter()
+    for round in range(args.rounds):
+        client.write_batch([(topic, [line(topic.split('/')[1], round)], (topic, round)) for topic in topics])
+    submitted = time.perf_counter() - started
+    while client.pending():
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    points = args.devices * args.rounds
+    received = sum(standIn.lines.values())
+    print('write: {} points in {:.2f}s ({:.0f} points/s), submit {:.1f} us/point, {} requests'.format(
+        points, elapsed, points / elapsed, submitted / points * 1e6, standIn.requests))
+
+    started = time.perf_counter()
+    healthy = sum(client.isPoolConnected(pool) for pool in client.poolKeys())
+    print('health: {} of {} pools pass in {:.1f} ms'.format(healthy, len(client.poolKeys()), (time.perf_counter() - started) * 1e3))
+
+    failed = client.takeFailed()
+    client.close()
+    standIn.stop()
+
+    assert received == points, 'stand-in received {} of {} points'.format(received, points)
+    assert len(standIn.lines) == destinations, 'points were written to {} buckets'.format(len(standIn.lines))
+    assert not failed, '{} messages failed'.format(len(failed))
+
+if __name__ == '__main__':
+    main()
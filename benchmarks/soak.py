@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Soak benchmark: replay a week of accelerated fleet traffic through the queue,
+decoder and sinks, and check that RSS and object counts level off.
+
+    $ python3 benchmarks/soak.py --devices 200 --days 7
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import app.prometheus
+from app.application import Application
+
+CONFIG = '''
+modules:
+  InfluxClient:
+    enabled: true
+    url: "http://127.0.0.1:1"
+    token: "t"
+    org: home
+    bucket: monitoring
+    max_inflight: 100
+  MQTTClient:
+    host: 127.0.0.1
+    port: 1
+    user: "u"
+    password: "p"
+    client_id: soak
+  PrometheusClient:
+    enabled: true
+    port: 0
+    series_ttl: 3600
+  Application:
+    queue_size: 10000
+    batch_size: {batch}
+sensors:
+  PZEM004TSensor:
+    quality:
+      enabled: true
+    schedule:
+      t1:
+        conditions:
+            - after: '00:00:00'
+              before: '12:00:00'
+      t2:
+        conditions:
+            - after: '12:00:00'
+              before: '00:00:00'
+'''
+
+TELEPERIOD = 300
+CHURN = 0.2
+
+class DoneResult(object):
+    def ready(self):
+        return True
+
+    def successful(self):
+        return True
+
+class FakeWriteApi(object):
+    def write(self, **kwargs):
+        return DoneResult()
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+def rss() -> int:
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+def payload(moment: datetime.datetime, total: float) -> str:
+    return json.dumps({
+        'Time': moment.strftime('%Y-%m-%dT%H:%M:%S'),
+        'ENERGY': {
+            'TotalStartTime': '2022-01-01T00:00:00', 'Total': total, 'Yesterday': 1.0, 'Today': 2.0, 'Period': 1,
+            'Power': 100 + total % 50, 'ApparentPower': 110, 'ReactivePower': 10, 'Factor': 0.9,
+            'Frequency': 50, 'Voltage': 230, 'Current': 0.5,
+        },
+        'ESP32': {'Temperature': 40.0},
+        'TempUnit': 'C',
+    })
+
+async def replay(application: Application, clock: Clock, devices: int, days: int) -> list:
+    task = asyncio.current_task()
+    start = datetime.datetime(2022, 10, 17)
+    fleet = ['device{}'.format(index) for index in range(devices)]
+    spawned = devices
+    samples = []
+
+    for day in range(days):
+        ## part of the fleet is replaced every day, their series must be evicted
+        for index in range(int(devices * CHURN)):
+            fleet[(day * int(devices * CHURN) + index) % devices] = 'device{}'.format(spawned)
+            spawned += 1
+
+        for tick in range(0, 86400, TELEPERIOD):
+            clock.now = day * 86400 + tick
+            moment = start + datetime.timedelta(seconds=clock.now)
+            for index, device in enumerate(fleet):
+                application.onMessageCallback('tele/{}/SENSOR'.format(device), payload(moment, clock.now / 3600 + index))
+
+            await application.processQueue(task)
+            if tick % 3600 == 0:
+                application.prometheus.evict()
+                application.quality.evict()
+
+        gc.collect()
+        samples.append((day + 1, rss(), len(gc.get_objects()), len(application.prometheus.lastSeen), application.queue.qsize(),
+                        len(application.quality.devices)))
+        print('day {}: rss {:.1f} MiB, objects {}, series {}, queue {}, analyzer devices {}'.format(
+            samples[-1][0], samples[-1][1] / 2 ** 20, samples[-1][2], samples[-1][3], samples[-1][4], samples[-1][5]), flush=True)
+
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, default=200)
+    parser.add_argument('--days', type=int, default=7)
+    parser.add_argument('--batch', type=int, default=0, help='Application.batch_size')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='allowed growth over second half of run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    clock = Clock()
+    app.prometheus.time.monotonic = clock.monotonic
+
+    with tempfile.TemporaryDirectory() as root:
+        os.mkdir(os.path.join(root, 'config'))
+        with open(os.path.join(root, 'config', 'app.yaml'), 'w') as file:
+            file.write(CONFIG.format(batch=args.batch))
+
+        application = Application(root, logging)
+        application.influx.pools[application.influx.destination.pool] = (None, FakeWriteApi())
+
+        started = time.perf_counter()
+        samples = asyncio.run(replay(application, clock, args.devices, args.days))
+        elapsed = time.perf_counter() - started
+
+    messages = args.devices * args.days * 86400 // TELEPERIOD
+    print('{} messages in {:.1f}s, {:.1f} us/message'.format(messages, elapsed, elapsed / messages * 1e6))
+
+    ## compare middle and end of run, warm up (caches, first churn) happens before
+    middle = samples[len(samples) // 2 - 1]
+    last = samples[-1]
+    rssGrowth = (last[1] - middle[1]) / middle[1]
+    objectsGrowth = (last[2] - middle[2]) / middle[2]
+    print('growth over second half: rss {:+.2%}, objects {:+.2%}'.format(rssGrowth, objectsGrowth))
+
+    assert rssGrowth < args.tolerance, 'RSS keeps growing'
+    assert objectsGrowth < args.tolerance, 'object count keeps growing'
+    assert last[3] <= middle[3] * (1 + args.tolerance), 'Prometheus series keep growing'
+    assert last[5] <= middle[5] * (1 + args.tolerance), 'analyzer state keeps growing'
+
+if __name__ == '__main__':
+    main()
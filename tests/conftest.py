@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import logging
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from app.config import Config
+
+SCHEDULE = {
+    't1': {'conditions': [{'after': '07:00:00', 'before': '22:59:59'}]},
+    't2': {'conditions': [{'after': '00:00:01', 'before': '06:59:59'}, {'after': '23:00:00', 'before': '00:00:00'}]},
+}
+
+## Build Config without reading config/app.yaml
+def makeConfig(modules: dict = None, sensor: dict = None) -> Config:
+    config = Config(logging.getLogger('tests'), os.getcwd())
+    config.modulesConfigCache = modules or {}
+    config.sensorsConfigCache = {'PZEM004TSensor': dict({'schedule': SCHEDULE}, **(sensor or {}))}
+    return config
+
+@pytest.fixture
+def logger():
+    return logging.getLogger('tests')
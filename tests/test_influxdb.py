@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import asyncio
+import threading
+import pytest
+from multiprocessing.pool import ThreadPool
+from prometheus_client import REGISTRY
+from conftest import makeConfig
+from app.influxdb import InfluxClient
+from app.application import Application
+
+CAPTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'captures')
+
+CONFIG = '''
+modules:
+  InfluxClient:
+    enabled: true
+    url: "http://influx:8086"
+    token: "t"
+    org: home
+    bucket: monitoring
+  MQTTClient:
+    host: 127.0.0.1
+    port: 1
+    user: "u"
+    password: "p"
+    client_id: retry-test
+  PrometheusClient:
+    enabled: true
+    port: 0
+  Application:
+    batch_size: {batch}
+sensors:
+  PZEM004TSensor:
+    quality:
+      enabled: true
+    schedule:
+      t1:
+        conditions:
+            - after: '00:00:00'
+              before: '12:00:00'
+      t2:
+        conditions:
+            - after: '12:00:00'
+              before: '00:00:00'
+'''
+
+class ApiError(Exception):
+    def __init__(self, status):
+        super().__init__('status {}'.format(status))
+        self.status = status
+
+class FakeWriteApi(object):
+    """ Asynchronous write API answering after release() """
+
+    def __init__(self, error=None):
+        self.pool = ThreadPool(4)
+        self.released = threading.Event()
+        self.error = error
+        self.writes = []
+
+    def write(self, bucket, org, record, write_precision):
+        self.writes.append((bucket, org, list(record)))
+        return self.pool.apply_async(self.answer)
+
+    def answer(self):
+        self.released.wait(5)
+        if self.error is not None:
+            raise self.error
+
+    def release(self):
+        self.released.set()
+        time.sleep(0.1)
+
+def makeClient(logger, writeApi, **module):
+    config = dict({'url': 'http://influx:8086', 'token': 't', 'org': 'home', 'bucket': 'monitoring', 'enabled': True}, **module)
+    client = InfluxClient(logger, makeConfig({'InfluxClient': config}))
+    client.pools[client.destination.pool] = (None, writeApi)
+    return client
+
+def batch(count, offset=0):
+    return [('tele/d{}/SENSOR'.format(index), [{'index': index}], ('tele/d{}/SENSOR'.format(index), str(index)))
+            for index in range(offset, offset + count)]
+
+def test_limit_refuses_without_blocking(logger):
+    writeApi = FakeWriteApi()
+    client = makeClient(logger, writeApi, max_inflight=2)
+
+    started = time.monotonic()
+    client.write_batch(batch(1))
+    assert client.canWrite()
+    client.write_batch(batch(1, 1))
+    assert not client.canWrite()
+    assert time.monotonic() - started < 0.5
+    assert client.pending() == 2
+
+    writeApi.release()
+    assert client.canWrite()
+    assert client.pending() == 0
+
+def test_failed_writes_are_returned_for_retry(logger):
+    writeApi = FakeWriteApi(ApiError(503))
+    client = makeClient(logger, writeApi)
+
+    client.write_batch(batch(3))
+    writeApi.release()
+    assert sorted(client.takeFailed()) == sorted(batch(3))
+    assert client.takeFailed() == []
+
+def test_rejected_writes_are_dropped(logger):
+    writeApi = FakeWriteApi(ApiError(400))
+    client = makeClient(logger, writeApi)
+
+    client.write_batch(batch(3))
+    writeApi.release()
+    assert client.takeFailed() == []
+
+def test_abandon_returns_pending_messages(logger):
+    writeApi = FakeWriteApi()
+    client = makeClient(logger, writeApi)
+
+    client.write_batch(batch(2))
+    assert sorted(client.abandon()) == sorted(message for _, _, message in batch(2))
+    assert client.pending() == 0
+    writeApi.release()
+
+def test_missing_connection_keeps_messages(logger):
+    client = makeClient(logger, FakeWriteApi())
+    client.pools = {}
+
+    client.write_batch(batch(2))
+    assert not client.canWrite()
+    assert len(client.takeFailed()) == 2
+    assert client.canWrite()
+
+def test_events_are_retried_but_not_spooled(logger):
+    writeApi = FakeWriteApi(ApiError(503))
+    client = makeClient(logger, writeApi)
+
+    events = [('tele/d1/SENSOR', [{'event': 1}], None)]
+    client.write_batch(events + batch(1))
+    writeApi.release()
+    failed = client.takeFailed()
+    assert failed == events + batch(1)
+
+    writeApi.released.clear()
+    client.write_batch(failed)
+    assert writeApi.writes[-1] == ('monitoring', 'home', [{'event': 1}, {'index': 0}])
+    assert client.abandon() == [message for _, _, message in batch(1)]
+    writeApi.release()
+
+class Health(object):
+    def __init__(self, status):
+        self.status = status
+
+class FakeClient(object):
+    def __init__(self, status='pass'):
+        self.status = status
+        self.url = 'http://influx'
+        self.api_client = self
+        self.timeouts = []
+
+    def close(self):
+        pass
+
+class FakeHealthService(object):
+    """ Health endpoint of FakeClient """
+
+    def __init__(self, api_client):
+        self.client = api_client
+
+    def get_health(self, _request_timeout=None):
+        self.client.timeouts.append(_request_timeout)
+        if self.client.status is None:
+            raise ConnectionError('refused')
+        return Health(self.client.status)
+
+ROUTES = [
+    {'match': {'device': 'kitchen*'}, 'bucket': 'kitchen'},
+    {'match': {'topic': 'tele/garage/#'}, 'org': 'garage', 'bucket': 'garage'},
+]
+
+def test_routes_first_matching_rule_wins(logger):
+    client = makeClient(logger, FakeWriteApi(), routes=ROUTES)
+
+    assert client.route('tele/kitchen_1/SENSOR').bucket == 'kitchen'
+    assert client.route('tele/garage/door/SENSOR').org == 'garage'
+    assert client.route('tele/bedroom/SENSOR') is client.destination
+    assert client.route(None) is client.destination
+
+def test_write_batch_groups_by_destination(logger):
+    writeApi = FakeWriteApi()
+    client = makeClient(logger, writeApi, routes=ROUTES)
+    client.pools[client.route('tele/garage/door/SENSOR').pool] = (None, writeApi)
+
+    client.write_batch([
+        ('tele/kitchen_1/SENSOR', ['a'], None),
+        ('tele/bedroom/SENSOR', ['b'], None),
+        ('tele/kitchen_2/SENSOR', ['c'], None),
+        ('tele/garage/door/SENSOR', ['d'], None),
+    ])
+    writeApi.release()
+    assert sorted(writeApi.writes) == [('garage', 'garage', ['d']), ('kitchen', 'home', ['a', 'c']), ('monitoring', 'home', ['b'])]
+
+def test_only_failing_pool_is_reconnected(logger, monkeypatch):
+    monkeypatch.setattr('app.influxdb.HealthService', FakeHealthService)
+    client = makeClient(logger, FakeWriteApi(), routes=ROUTES)
+    garage = client.route('tele/garage/door/SENSOR').pool
+    client.pools = {client.destination.pool: (FakeClient(), FakeWriteApi()), garage: (FakeClient(None), FakeWriteApi())}
+    healthy = client.pools[client.destination.pool]
+
+    assert client.poolKeys() == [client.destination.pool, garage]
+    assert client.isPoolConnected(client.destination.pool)
+    assert not client.isPoolConnected(garage)
+    ## check does not wait for client timeout
+    assert healthy[0].timeouts == [2000]
+
+    client.close(garage)
+    assert client.pools == {client.destination.pool: healthy}
+
+async def process(application: Application) -> None:
+    await application.processQueue(asyncio.current_task())
+
+## Prometheus samples of a device, events included
+def samples(device: str) -> dict:
+    return {
+        (metric.name, sample.name, tuple(sorted(sample.labels.items()))): sample.value
+        for metric in REGISTRY.collect() for sample in metric.samples if sample.labels.get('device') == device
+    }
+
+@pytest.mark.parametrize('batch', [0, 100])
+def test_retry_does_not_process_messages_again(tmp_path, logger, batch):
+    device = 'retried{}'.format(batch)
+    os.mkdir(tmp_path / 'config')
+    (tmp_path / 'config' / 'app.yaml').write_text(CONFIG.format(batch=batch))
+    application = Application(str(tmp_path), logger)
+    writeApi = FakeWriteApi(ApiError(503))
+    application.influx.pools[application.influx.destination.pool] = (None, writeApi)
+
+    with open(os.path.join(CAPTURES, 'quality.jsonl')) as file:
+        for message in map(json.loads, file):
+            if message['topic'] == 'tele/kitchen/SENSOR':
+                application.enqueue((message['topic'].replace('kitchen', device), message['payload'], message['received']))
+    asyncio.run(process(application))
+    writeApi.release()
+
+    published = samples(device)
+    assert published[('energy_power_quality_events', 'energy_power_quality_events_total', (
+        ('device', device), ('deviceclass', 'energy'), ('event', 'sag'), ('measurement', 'energy_events'), ('sensor', 'pzem004t')))] == 1
+    written = sorted(map(repr, (record for _, _, records in writeApi.writes for record in records)))
+
+    ## InfluxDB answers 503 to every retry
+    for _ in range(5):
+        writeApi.writes.clear()
+        application.canProcess()
+        time.sleep(0.1)
+        assert sorted(map(repr, (record for _, _, records in writeApi.writes for record in records))) == written
+        assert samples(device) == published
+    assert application.queue.empty()
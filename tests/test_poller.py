@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import asyncio
+import pytest
+from aiohttp import web
+from conftest import makeConfig
+from app.poller import HTTPPoller
+from app.sensors.pzem004t import PZEM004TSensor, PZEM004TBatch
+
+## STATUS 8 answer outside of telemetry period, ENERGY has no Period
+STATUS = {
+    'StatusSNS': {
+        'Time': '2022-10-17T12:00:00',
+        'ENERGY': {
+            'TotalStartTime': '2022-01-01T00:00:00', 'Total': 10.5, 'Yesterday': 1.0, 'Today': 2.0,
+            'Power': 100, 'ApparentPower': 110, 'ReactivePower': 10, 'Factor': 0.9,
+            'Frequency': 50, 'Voltage': 230, 'Current': 0.5,
+        },
+        'ESP32': {'Temperature': 40.0},
+        'TempUnit': 'C',
+    }
+}
+
+async def poll(logger, handler, devices: int, seconds: float, **module) -> list:
+    app = web.Application()
+    app.router.add_get('/{name}/cm', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+
+    config = dict({'enabled': True, 'interval': 0.2, 'devices': [
+        {'name': 'd{}'.format(index), 'url': 'http://127.0.0.1:{}/d{}/cm?cmnd=STATUS+8'.format(port, index)}
+        for index in range(devices)
+    ]}, **module)
+    poller = HTTPPoller(logger, makeConfig({'HTTPPoller': config}))
+
+    messages = []
+    task = asyncio.ensure_future(poller.run(lambda topic, payload: messages.append((topic, payload))))
+    await asyncio.sleep(seconds)
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    await runner.cleanup()
+    return messages
+
+def test_status_without_period_is_decoded(logger):
+    async def handler(request):
+        return web.json_response(STATUS)
+
+    messages = asyncio.run(poll(logger, handler, 3, 0.6))
+    assert {topic for topic, _ in messages} == {'tele/d0/SENSOR', 'tele/d1/SENSOR', 'tele/d2/SENSOR'}
+
+    topic, payload = messages[0]
+    points = PZEM004TSensor(payload).get(makeConfig(), topic, 1666000000)
+    assert points[0]['fields']['period'] == 0
+    assert points[0]['tags']['device'] == topic.split('/')[1]
+
+    columns = PZEM004TBatch(makeConfig()).decode([(topic, payload, 1666000000) for topic, payload in messages])
+    assert len(columns['topic']) == len(messages)
+    assert columns['period'].tolist() == [0] * len(messages)
+
+def test_failing_device_does_not_stop_others(logger):
+    async def handler(request):
+        if request.match_info['name'] == 'd0':
+            raise web.HTTPServiceUnavailable()
+        return web.json_response(STATUS)
+
+    messages = asyncio.run(poll(logger, handler, 2, 0.6))
+    assert messages
+    assert {topic for topic, _ in messages} == {'tele/d1/SENSOR'}
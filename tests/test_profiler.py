@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import asyncio
+import urllib.request
+import urllib.error
+import pytest
+from conftest import makeConfig
+from app.profiler import ProfilerClient
+
+def request(profiler, path):
+    host, port = profiler.server.server_address
+    try:
+        with urllib.request.urlopen('http://{}:{}{}'.format(host, port, path), timeout=10) as response:
+            return response.status, response.read().decode('utf-8')
+    except urllib.error.HTTPError as error:
+        return error.code, error.read().decode('utf-8')
+
+## Start profiler on running loop with a busy task, run requests from worker thread
+def run(logger, paths):
+    profiler = ProfilerClient(logger, makeConfig({'ProfilerClient': {'enabled': True, 'port': 0}}))
+
+    async def busy():
+        while True:
+            sum(range(1000))
+            await asyncio.sleep(0)
+
+    async def main():
+        profiler.start(asyncio.get_running_loop())
+        task = asyncio.get_running_loop().create_task(busy(), name='busy')
+        try:
+            return [await asyncio.to_thread(request, profiler, path) for path in paths]
+        finally:
+            task.cancel()
+            profiler.stop()
+
+    return asyncio.run(main())
+
+def test_profile(logger):
+    [(status, body)] = run(logger, ['/profile?seconds=0.3&limit=5'])
+    assert status == 200
+    assert 'function calls' in body
+    assert 'busy' in body
+
+def test_sample(logger):
+    [(status, body)] = run(logger, ['/sample?seconds=0.3&interval=0.002'])
+    assert status == 200
+    lines = body.splitlines()
+    assert lines
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        assert int(count) > 0
+    assert any('run_forever' in line for line in lines)
+
+def test_tasks(logger):
+    [(status, body)] = run(logger, ['/tasks'])
+    assert status == 200
+    tasks = {task['name']: task for task in json.loads(body)}
+    assert tasks['busy']['state'] == 'pending'
+    assert tasks['busy']['coroutine'].endswith('busy')
+
+def test_tracemalloc(logger):
+    results = run(logger, [
+        '/tracemalloc/snapshot',
+        '/tracemalloc/start?frames=5',
+        '/tracemalloc/snapshot?limit=3',
+        '/tracemalloc/diff?limit=3',
+        '/tracemalloc/stop',
+        '/tracemalloc/diff',
+    ])
+    statuses = [status for status, _ in results]
+    assert statuses == [500, 200, 200, 200, 200, 500]
+    assert 'started with 5 frames' in results[1][1]
+    assert results[2][1].startswith('current=')
+
+def test_unknown_endpoint(logger):
+    [(status, body)] = run(logger, ['/nope'])
+    assert status == 404
+    assert '/profile' in body
+
+def test_concurrent_sessions_are_refused(logger):
+    profiler = ProfilerClient(logger, makeConfig({'ProfilerClient': {'enabled': True, 'port': 0}}))
+    profiler.lock.acquire()
+    with pytest.raises(RuntimeError):
+        profiler.sample({'seconds': '0.1'})
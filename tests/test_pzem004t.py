@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+from conftest import makeConfig
+from app.sensors.pzem004t import PZEM004TSensor, PZEM004TBatch, SCHEDULE_UNDEFINED
+
+RECEIVED = 1666000000.4
+
+def payload(time='2022-10-17T12:00:00', **energy):
+    return json.dumps({
+        'Time': time,
+        'ENERGY': dict({
+            'TotalStartTime': '2022-01-01T00:00:00', 'Total': 10.5, 'Yesterday': 1.25, 'Today': 2.5, 'Period': 3,
+            'Power': 100, 'ApparentPower': 110, 'ReactivePower': 10, 'Factor': 0.91,
+            'Frequency': 49.98, 'Voltage': 230.4, 'Current': 0.5,
+        }, **energy),
+        'ESP32': {'Temperature': 40.0},
+        'TempUnit': 'C',
+    })
+
+## Parse line protocol rendered by PZEM004TBatch (no spaces in keys or values)
+def parseLine(line: str) -> dict:
+    head, fields, time = line.split(' ')
+    measurement, *tags = head.split(',')
+
+    values = {}
+    for field in fields.split(','):
+        key, value = field.split('=', 1)
+        if value.startswith('"'):
+            values[key] = value[1:-1]
+        elif value.endswith('i'):
+            values[key] = int(value[:-1])
+        else:
+            values[key] = float(value)
+
+    tags = dict(tag.split('=', 1) for tag in tags)
+    tags['time_period_id'] = int(tags['time_period_id'])
+    return {'measurement': measurement, 'tags': tags, 'fields': values, 'time': int(time)}
+
+@pytest.mark.parametrize('time, period', [
+    ('2022-10-17T12:00:00', 't1'),
+    ('2022-10-17T03:00:00', 't2'),
+    ('2022-10-17T23:30:00', 't2'),
+    ## gaps between schedules of tests/conftest.py
+    ('2022-10-17T06:59:59', SCHEDULE_UNDEFINED),
+    ('2022-10-17T22:59:59', SCHEDULE_UNDEFINED),
+    ('2022-10-17T00:00:00', SCHEDULE_UNDEFINED),
+])
+def test_batch_matches_scalar(time, period):
+    config = makeConfig()
+    topic = 'tele/kitchen/SENSOR'
+    message = payload(time)
+
+    expected = PZEM004TSensor(message).get(config, topic, RECEIVED)[0]
+    assert expected['tags']['time_period'] == period
+
+    batch = PZEM004TBatch(config)
+    columns = batch.decode([(topic, message, RECEIVED)])
+    [(lineTopic, [line], lineMessage)] = batch.toLineProtocol(columns)
+
+    assert lineTopic == topic
+    assert lineMessage == (topic, message, RECEIVED)
+    assert parseLine(line) == expected
+    assert batch.latest(columns) == [expected]
+
+def test_point_is_stamped_with_receive_time():
+    point = PZEM004TSensor(payload('2000-01-01T00:00:00')).get(makeConfig(), 'tele/kitchen/SENSOR', RECEIVED)[0]
+    assert point['time'] == 1666000000
+    assert point['tags']['device'] == 'kitchen'
+
+@pytest.mark.parametrize('message', [
+    payload(Power='n/a'),
+    payload(Voltage=None),
+    payload(Current=float('nan')),
+    payload(Total=True),
+    payload(TotalStartTime=None),
+    payload(time='garbage'),
+    payload(time=None),
+    payload(time='2022-10-17T24:00:00'),
+    payload(time='2022-10-17 12:00:00'),
+    payload(time='2022-10-17T12:-1:00'),
+    '{"Time": "2022-10-17T12:00:00"}',
+    '{"Time": "2022-10-17T12:00:00", "ENERGY": []}',
+    'not json',
+])
+def test_malformed_message_does_not_drop_batch(message):
+    batch = PZEM004TBatch(makeConfig())
+    good = [('tele/d{}/SENSOR'.format(index), payload(), RECEIVED + index) for index in range(3)]
+
+    columns = batch.decode(good[:1] + [('tele/bad/SENSOR', message, RECEIVED)] + good[1:])
+    assert columns['topic'] == ['tele/d0/SENSOR', 'tele/d1/SENSOR', 'tele/d2/SENSOR']
+    assert columns['message'] == good
+    assert columns['time'].tolist() == [1666000000, 1666000001, 1666000002]
+    assert len(batch.toLineProtocol(columns)) == 3
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import pytest
+from conftest import makeConfig
+from prometheus_client import REGISTRY
+from app.quality import PowerQualityAnalyzer
+from app.prometheus import PrometheusClient
+from app.sensors.pzem004t import PZEM004TSensor, PZEM004TBatch
+
+CAPTURES = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'captures')
+
+## Events in tests/captures/quality.jsonl: kitchen reports 49.98 Hz all the time and has
+## one sag and one load step, garage drifts to 50.9 Hz for 200 seconds
+EXPECTED = [
+    ('kitchen', 'sag', 'start', 1666000100),
+    ('kitchen', 'sag', 'end', 1666000130),
+    ('garage', 'frequency_drift', 'start', 1666000173),
+    ('kitchen', 'load_step', 'up', 1666000250),
+    ('garage', 'frequency_drift', 'end', 1666000363),
+]
+
+def capture(name: str) -> list:
+    with open(os.path.join(CAPTURES, name)) as file:
+        return [(message['topic'], message['payload'], message['received']) for message in map(json.loads, file)]
+
+def summary(events: list) -> list:
+    return [(event['tags']['device'], event['tags']['event'], event['tags']['state'], event['time']) for event in events]
+
+@pytest.fixture
+def config():
+    return makeConfig(sensor={'quality': {'enabled': True}})
+
+def test_replay_scalar(logger, config):
+    analyzer = PowerQualityAnalyzer(logger, config)
+    events = []
+    for topic, payload, received in capture('quality.jsonl'):
+        sensor = PZEM004TSensor(payload)
+        point = sensor.get(config, topic, received)[0]
+        events.extend(analyzer.analyze(topic, sensor.sensor, point['time']))
+    assert summary(events) == EXPECTED
+
+@pytest.mark.parametrize('size', [1, 7, 1000])
+def test_replay_batch(logger, config, size):
+    analyzer = PowerQualityAnalyzer(logger, config)
+    batch = PZEM004TBatch(config)
+    messages = capture('quality.jsonl')
+
+    events = []
+    for index in range(0, len(messages), size):
+        for topic, deviceEvents in analyzer.analyzeColumns(batch.decode(messages[index:index + size])):
+            events.extend(deviceEvents)
+    assert summary(events) == EXPECTED
+
+def test_replayed_samples_are_ignored(logger, config):
+    analyzer = PowerQualityAnalyzer(logger, config)
+    messages = capture('quality.jsonl')
+    batch = PZEM004TBatch(config)
+
+    events = []
+    for index in range(0, len(messages), 10):
+        ## every batch is analyzed twice, second one is one sample back
+        for start in (index, max(0, index - 1)):
+            for topic, deviceEvents in analyzer.analyzeColumns(batch.decode(messages[start:start + 10])):
+                events.extend(deviceEvents)
+    assert summary(events) == EXPECTED
+
+    sag = analyzer.observe('kitchen', 1666000000, 195.0, 50.0, 200.0)
+    assert sag == []
+    assert analyzer.devices['kitchen'].voltage is None
+
+def test_idle_device_state_is_evicted(logger, config, monkeypatch):
+    analyzer = PowerQualityAnalyzer(logger, config)
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+
+    analyzer.observe('old', None, 230, 50, 100)
+    now[0] += 3000
+    analyzer.observe('new', None, 230, 50, 100)
+    now[0] += 1000
+    assert analyzer.evict() == 1
+    assert list(analyzer.devices) == ['new']
+
+def test_event_series_are_evicted_with_device(logger, config, monkeypatch):
+    prometheus = PrometheusClient(logger, makeConfig({'PrometheusClient': {'port': 0, 'enabled': True, 'series_ttl': 60}}))
+    analyzer = PowerQualityAnalyzer(logger, config)
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+
+    messages = [(topic.replace('kitchen', 'evicted'), payload, received) for topic, payload, received in capture('quality.jsonl')]
+    batch = PZEM004TBatch(config)
+    columns = batch.decode(messages)
+    prometheus.publish(batch.latest(columns))
+    for topic, events in analyzer.analyzeColumns(columns):
+        prometheus.publishEvents(events)
+
+    labels = {'measurement': 'energy_events', 'deviceclass': 'energy', 'sensor': 'pzem004t', 'device': 'evicted'}
+    assert REGISTRY.get_sample_value('energy_power_quality_events_total', dict(labels, event='sag')) == 1
+    assert REGISTRY.get_sample_value('energy_power_quality_events_total', dict(labels, event='load_step')) == 1
+
+    now[0] += 120
+    assert prometheus.evict() == 2
+    assert REGISTRY.get_sample_value('energy_power_quality_events_total', dict(labels, event='sag')) is None
+    assert REGISTRY.get_sample_value('energy_power_quality_events_total', dict(labels, event='load_step')) is None
+    assert REGISTRY.get_sample_value('energy_voltage_current', {'measurement': 'energy', 'deviceclass': 'energy', 'sensor': 'pzem004t', 'device': 'evicted'}) is None
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import subprocess
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from app.application import Application
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+CONFIG = '''
+modules:
+  InfluxClient:
+    enabled: true
+    url: "{url}"
+    token: "t"
+    org: home
+    bucket: monitoring
+    max_inflight: 20
+  MQTTClient:
+    host: 127.0.0.1
+    port: 1
+    user: "u"
+    password: "p"
+    client_id: shutdown-test
+  PrometheusClient:
+    enabled: false
+    port: 0
+  Application:
+    queue_size: 1000000
+    batch_size: {batch}
+    shutdown_timeout: 3
+    spool_file: spool.jsonl
+sensors:
+  PZEM004TSensor:
+    schedule:
+      t1:
+        conditions:
+            - after: '00:00:00'
+              before: '12:00:00'
+      t2:
+        conditions:
+            - after: '12:00:00'
+              before: '00:00:00'
+'''
+
+## Application fed from a thread instead of MQTT broker, Total of every message is its sequence number.
+## Feeding stops when application disconnects from broker, like MQTT intake does.
+DRIVER = '''
+import sys, json, time, logging, threading
+sys.path.insert(0, sys.argv[2])
+from app.application import Application
+
+logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+application = Application(sys.argv[1], logging)
+stopped = threading.Event()
+sent = 0
+
+def feed():
+    global sent
+    while not stopped.is_set():
+        for _ in range(100):
+            application.onMessageCallback('tele/d{}/SENSOR'.format(sent % 100), json.dumps({
+                'Time': '2022-10-17T12:00:00',
+                'ENERGY': {'TotalStartTime': '2022-01-01T00:00:00', 'Total': sent, 'Yesterday': 1.0, 'Today': 2.0,
+                           'Period': 1, 'Power': 100, 'ApparentPower': 110, 'ReactivePower': 10, 'Factor': 0.9,
+                           'Frequency': 50, 'Voltage': 230, 'Current': 0.5},
+                'ESP32': {'Temperature': 40.0},
+                'TempUnit': 'C',
+            }))
+            sent += 1
+        time.sleep(0.01)
+
+feeder = threading.Thread(target=feed, daemon=True)
+disconnect = application.mqtt.disconnect
+def stop():
+    ## reconnect disconnects too, intake stops on shutdown only
+    if application.stopping.is_set():
+        stopped.set()
+        feeder.join()
+    disconnect()
+application.mqtt.disconnect = stop
+
+feeder.start()
+print('READY', flush=True)
+application.main()
+print('SENT', sent, flush=True)
+'''
+
+class InfluxStandIn(object):
+    """ InfluxDB write endpoint answering after latency, remembers Total of every written point.
+    Health endpoint answers after hang seconds. """
+
+    def __init__(self, latency: float, hang: float = 0) -> None:
+        self.written = set()
+        self.lock = threading.Lock()
+        standIn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                time.sleep(latency)
+                totals = set()
+                for line in body.splitlines():
+                    for field in line.split(' ')[1].split(','):
+                        if field.startswith('total='):
+                            totals.add(int(float(field[len('total='):])))
+                with standIn.lock:
+                    standIn.written |= totals
+                self.send_response(204)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_GET(self):
+                time.sleep(hang)
+                content = b'{"name": "influxdb", "status": "pass", "message": "ready"}'
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+@pytest.mark.parametrize('latency, batch', [(0.01, 0), (0.01, 1000), (2, 0), (2, 1000)])
+def test_sigterm_under_load_loses_nothing(tmp_path, latency, batch):
+    standIn = InfluxStandIn(latency)
+    os.mkdir(tmp_path / 'config')
+    (tmp_path / 'config' / 'app.yaml').write_text(CONFIG.format(url=standIn.url, batch=batch))
+
+    process = subprocess.Popen(
+        [sys.executable, '-c', DRIVER, str(tmp_path), ROOT],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        assert process.stdout.readline().strip() == 'READY'
+        time.sleep(2)
+
+        signalled = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+        output, _ = process.communicate(timeout=15)
+        elapsed = time.monotonic() - signalled
+    finally:
+        process.kill()
+        standIn.stop()
+
+    assert process.returncode == 0
+    ## docker sends SIGKILL 10 seconds after SIGTERM
+    assert elapsed < 10
+
+    sent = int(output.split('SENT')[1])
+    assert sent > 0
+
+    spooled = set()
+    spool = tmp_path / 'spool.jsonl'
+    if spool.exists():
+        for line in spool.read_text().splitlines():
+            spooled.add(json.loads(json.loads(line)['payload'])['ENERGY']['Total'])
+
+    ## a write answered after the deadline is both written and spooled, points are idempotent
+    missing = set(range(sent)) - standIn.written - spooled
+    assert not missing, '{} of {} messages lost, {} written, {} spooled'.format(len(missing), sent, len(standIn.written), len(spooled))
+
+def test_hanging_health_check_does_not_hold_up_exit(tmp_path):
+    standIn = InfluxStandIn(0.01, hang=60)
+    os.mkdir(tmp_path / 'config')
+    (tmp_path / 'config' / 'app.yaml').write_text(CONFIG.format(url=standIn.url, batch=0))
+
+    process = subprocess.Popen(
+        [sys.executable, '-c', DRIVER, str(tmp_path), ROOT],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        assert process.stdout.readline().strip() == 'READY'
+        ## health check of first connection is in flight
+        time.sleep(0.5)
+
+        signalled = time.monotonic()
+        process.send_signal(signal.SIGTERM)
+        process.communicate(timeout=15)
+        elapsed = time.monotonic() - signalled
+    finally:
+        process.kill()
+        standIn.stop()
+
+    assert process.returncode == 0
+    ## queue is drained in well under shutdown_timeout, exit waits for health timeout at most
+    assert elapsed < 5
+
+def test_restore_skips_malformed_lines(tmp_path, logger):
+    os.mkdir(tmp_path / 'config')
+    (tmp_path / 'config' / 'app.yaml').write_text(CONFIG.format(url='http://127.0.0.1:1', batch=0))
+    spool = tmp_path / 'spool.jsonl'
+    spool.write_bytes(b'\n'.join([
+        json.dumps({'topic': 'tele/d0/SENSOR', 'payload': '{}', 'received': 1666000000}).encode('utf-8'),
+        b'{"topic": "tele/d1/SENSOR", "payl',
+        b'\xff\xfe not utf-8',
+        json.dumps({'payload': '{}'}).encode('utf-8'),
+        json.dumps({'topic': 'tele/d2/SENSOR', 'payload': '{}'}).encode('utf-8'),
+    ]) + b'\n')
+
+    application = Application(str(tmp_path), logger)
+    assert application.restore() == 2
+    assert not spool.exists()
+
+    restored = [application.queue.get(block=False) for _ in range(application.queue.qsize())]
+    assert [topic for topic, _, _ in restored] == ['tele/d0/SENSOR', 'tele/d2/SENSOR']
+    assert restored[0][2] == 1666000000
+
+    ## nothing is replayed on next start
+    assert application.restore() == 0